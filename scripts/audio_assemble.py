@@ -0,0 +1,517 @@
+import os
+import sys
+import zlib
+import struct
+import threading
+from array import array
+from pathlib import Path
+
+# MP3: MPEG audio Layer III only, which is what the speech endpoint returns.
+# Version bits: 3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+BITRATES[0] = BITRATES[2]
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+XING_FLAGS = 0x0007  # frame count, byte count and seek table present
+TOC_ENTRIES = 100
+
+class FrameHeader:
+    """The fields of a 4-byte MPEG audio frame header that assembly needs."""
+
+    def __init__(self, data, offset=0):
+        b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+        if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+            raise ValueError("no frame sync")
+        self.version = (b1 >> 3) & 3
+        layer = (b1 >> 1) & 3
+        bitrate_index = b2 >> 4
+        sample_rate_index = (b2 >> 2) & 3
+        if self.version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            raise ValueError("not a Layer III frame with a fixed bitrate index")
+        self.bitrate = BITRATES[self.version][bitrate_index]
+        self.sample_rate = SAMPLE_RATES[self.version][sample_rate_index]
+        self.padding = (b2 >> 1) & 1
+        self.mono = (b3 >> 6) == 3
+        self.bytes = data[offset:offset + 4]
+
+    @property
+    def mpeg1(self):
+        return self.version == 3
+
+    @property
+    def samples(self):
+        return 1152 if self.mpeg1 else 576
+
+    @property
+    def length(self):
+        return (144 if self.mpeg1 else 72) * self.bitrate * 1000 // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self):
+        if self.mpeg1:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+def _id3v2_size(data):
+    """Length of an ID3v2 tag at the start of data, or 0."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def _is_info_frame(data, offset, header):
+    """True for a Xing/Info/VBRI header frame, which carries no audio."""
+    start = offset + 4 + header.side_info_size
+    return data[start:start + 4] in (b"Xing", b"Info") or data[offset + 36:offset + 40] == b"VBRI"
+
+def iter_frames(data):
+    """
+    (offset, header) for every complete audio frame in an MP3 file's
+    bytes, skipping ID3 tags, Xing/Info header frames and any junk
+    between frames.
+    """
+    end = len(data)
+    if end >= 128 and data[-128:-125] == b"TAG":
+        end -= 128
+    offset = _id3v2_size(data)
+    first = True
+    while offset + 4 <= end:
+        try:
+            header = FrameHeader(data, offset)
+        except ValueError:
+            offset += 1
+            continue
+        if offset + header.length > end:
+            break  # truncated last frame
+        if not (first and _is_info_frame(data, offset, header)):
+            yield offset, header
+        first = False
+        offset += header.length
+
+def _xing_frame(header, frames, size, toc):
+    """
+    A silent frame carrying a Xing header, in the format of header (an
+    audio frame of the stream), at the smallest bitrate that fits it.
+    """
+    side_info = header.side_info_size
+    needed = 4 + side_info + 4 + 4 + 4 + 4 + TOC_ENTRIES
+    for bitrate_index, bitrate in enumerate(BITRATES[header.version]):
+        if bitrate and (144 if header.mpeg1 else 72) * bitrate * 1000 // header.sample_rate >= needed:
+            break
+    else:
+        raise ValueError("no bitrate leaves room for a Xing header")
+    length = (144 if header.mpeg1 else 72) * bitrate * 1000 // header.sample_rate
+
+    b1 = header.bytes[1] | 0x01  # no CRC
+    b2 = (bitrate_index << 4) | (header.bytes[2] & 0x0C)  # keep the sample rate, no padding
+    frame = bytes([0xFF, b1, b2, header.bytes[3]]) + bytes(side_info)
+    frame += b"Xing" + struct.pack(">III", XING_FLAGS, frames, size) + bytes(toc)
+    return frame + bytes(length - len(frame))
+
+class ChunkAssembler:
+    """
+    Builds one audio file from numbered chunk files as they finish, in
+    number order, by copying their encoded audio: nothing is re-encoded
+    and no file list or ffmpeg process is needed. add() may be called from
+    any thread and in any order; a chunk is appended as soon as every
+    chunk before it has been. finish() completes the file and moves it
+    into place. Subclasses handle one container format each.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = Path(output_file)
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.part_file = self.output_file.with_name(self.output_file.name + ".part")
+        self._out = open(self.part_file, "wb")
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._next = 1
+        self.sample_rate = None
+        self.samples = 0
+        self.finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.finished:
+            self.abort()
+
+    def add(self, number, chunk_file):
+        """Record that chunk number (counting from 1) is ready at chunk_file."""
+        with self._lock:
+            self._waiting[number] = Path(chunk_file)
+            while self._next in self._waiting:
+                chunk_file = self._waiting.pop(self._next)
+                self._append(chunk_file.read_bytes(), chunk_file.name)
+                self._next += 1
+
+    def _append(self, data, name):
+        raise NotImplementedError
+
+    def _finalize(self):
+        """Write whatever the format needs once all audio is in."""
+
+    def _check_sample_rate(self, sample_rate, name):
+        if self.sample_rate is None:
+            self.sample_rate = sample_rate
+        elif sample_rate != self.sample_rate:
+            raise ValueError(f"{name} is {sample_rate} Hz, the first chunk was {self.sample_rate} Hz")
+
+    @property
+    def duration(self):
+        """Seconds of audio appended so far."""
+        return self.samples / self.sample_rate if self.sample_rate else 0.0
+
+    def finish(self, count):
+        """Check chunks 1..count were all appended, complete the file and move it into place."""
+        with self._lock:
+            if self._next <= count:
+                raise RuntimeError(f"Chunk {self._next} of {count} never arrived")
+            if self.sample_rate is None:
+                raise RuntimeError("No audio in any chunk")
+            self._finalize()
+            self._out.close()
+            os.replace(self.part_file, self.output_file)
+            self.finished = True
+        print(f"Assembled {count} chunks into {self.output_file} ({audio_report(self.output_file, self.duration)})")
+        return self.output_file
+
+    def abort(self):
+        """Close and remove the partial output."""
+        self._out.close()
+        self.part_file.unlink(missing_ok=True)
+
+class Mp3Assembler(ChunkAssembler):
+    """
+    MP3 chunks: frames are copied and finish() fills in a Xing header, so
+    players show the right duration and can seek.
+    """
+
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self._header = None
+        self._header_length = 0
+        self._frame_offsets = array("Q")
+        self._audio_bytes = 0
+
+    def _append(self, data, name):
+        for offset, header in iter_frames(data):
+            if self._header is None:
+                # Room for the Xing frame, written for real in finish()
+                self._header = header
+                self._header_length = len(_xing_frame(header, 0, 0, bytes(TOC_ENTRIES)))
+                self._out.write(bytes(self._header_length))
+            elif header.version != self._header.version:
+                raise ValueError(f"{name} is a different MPEG version from the first chunk")
+            self._check_sample_rate(header.sample_rate, name)
+            self._frame_offsets.append(self._audio_bytes)
+            self._out.write(data[offset:offset + header.length])
+            self._audio_bytes += header.length
+            self.samples += header.samples
+
+    def _toc(self):
+        """Xing seek table: byte position at each 1% of the duration, in 256ths of the file."""
+        frames = len(self._frame_offsets)
+        total = self._header_length + self._audio_bytes
+        toc = []
+        for percent in range(TOC_ENTRIES):
+            position = self._header_length + self._frame_offsets[min(frames - 1, frames * percent // TOC_ENTRIES)]
+            toc.append(min(255, position * 256 // total))
+        return toc
+
+    def _finalize(self):
+        total = self._header_length + self._audio_bytes
+        self._out.seek(0)
+        self._out.write(_xing_frame(self._header, len(self._frame_offsets), total, self._toc()))
+
+# AAC in ADTS framing, as the speech endpoint returns it
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+
+def iter_adts_frames(data):
+    """(offset, length, sample_rate, samples) for every complete ADTS frame in data."""
+    end = len(data)
+    offset = _id3v2_size(data)
+    while offset + 7 <= end:
+        if data[offset] != 0xFF or (data[offset + 1] & 0xF6) != 0xF0:
+            offset += 1
+            continue
+        rate_index = (data[offset + 2] >> 2) & 0x0F
+        length = ((data[offset + 3] & 0x03) << 11) | (data[offset + 4] << 3) | (data[offset + 5] >> 5)
+        if rate_index >= len(ADTS_SAMPLE_RATES) or length < 7:
+            offset += 1
+            continue
+        if offset + length > end:
+            break  # truncated last frame
+        yield offset, length, ADTS_SAMPLE_RATES[rate_index], ((data[offset + 6] & 0x03) + 1) * 1024
+        offset += length
+
+class AdtsAssembler(ChunkAssembler):
+    """AAC chunks: every ADTS frame carries its own header, so frames are simply copied."""
+
+    def _append(self, data, name):
+        for offset, length, sample_rate, samples in iter_adts_frames(data):
+            self._check_sample_rate(sample_rate, name)
+            self._out.write(data[offset:offset + length])
+            self.samples += samples
+
+# Ogg Opus (RFC 7845). Granule positions are always in 48 kHz samples.
+OGG_PAGE = struct.Struct("<4sBBqIIIB")
+OGG_CONTINUED, OGG_FIRST, OGG_LAST = 0x01, 0x02, 0x04
+OPUS_GRANULE_RATE = 48000
+
+_BIT_REVERSE = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def ogg_crc(data):
+    """
+    The Ogg page checksum (CRC-32, polynomial 0x04C11DB7, not reflected),
+    computed with zlib's reflected CRC-32 on bit-reversed bytes.
+    """
+    crc = zlib.crc32(data.translate(_BIT_REVERSE), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+def iter_ogg_pages(data):
+    """(header_type, granule, lacing, body) for every complete Ogg page in data."""
+    offset = 0
+    while offset + OGG_PAGE.size <= len(data):
+        if data[offset:offset + 4] != b"OggS":
+            offset = data.find(b"OggS", offset + 1)
+            if offset < 0:
+                break
+            continue
+        _, _, header_type, granule, _, _, _, segments = OGG_PAGE.unpack_from(data, offset)
+        lacing = data[offset + OGG_PAGE.size:offset + OGG_PAGE.size + segments]
+        body_start = offset + OGG_PAGE.size + segments
+        body_end = body_start + sum(lacing)
+        if len(lacing) < segments or body_end > len(data):
+            break  # truncated last page
+        yield header_type, granule, lacing, data[body_start:body_end]
+        offset = body_end
+
+def opus_packet_samples(packet):
+    """Samples at 48 kHz decoded from one Opus packet, from its TOC byte (RFC 6716 3.1)."""
+    if not packet:
+        return 0
+    config = packet[0] >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        frame = (480, 960)[config % 2]
+    else:
+        frame = (120, 240, 480, 960)[config % 4]
+    code = packet[0] & 0x03
+    if code == 0:
+        frames = 1
+    elif code < 3:
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+def split_packets(lacing, body):
+    """The packets that end on a page, and the bytes of one continuing onto the next."""
+    packets = []
+    start = position = 0
+    for value in lacing:
+        position += value
+        if value < 255:
+            packets.append(body[start:position])
+            start = position
+    return packets, body[start:]
+
+class OggOpusAssembler(ChunkAssembler):
+    """
+    Opus chunks: each chunk is its own Ogg stream, so the first chunk's
+    OpusHead and OpusTags pages are kept and the audio pages of every chunk
+    are rewritten into that one stream, with page numbers and granule
+    positions continuing from the previous chunk. A chained file would
+    also be valid Ogg, but many players stop at the end of the first link.
+
+    Granule positions may only fall short of the decoded samples (end
+    trimming) on the last page of a stream, so each chunk's own trimmed
+    end is replaced by the samples its packets decode to, and only the
+    final chunk's trim is kept.
+    """
+
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self._serial = None
+        self._sequence = 0
+        self._granule_offset = 0
+        self._pre_skip = 0
+        self._pending = None
+        self._trimmed_end = 0
+
+    def _write_page(self, header_type, granule, lacing, body):
+        # Each page is held back until the next one, so the last can be
+        # marked as the end of the stream in finish()
+        if self._pending is not None:
+            self._flush_page(*self._pending)
+        self._pending = (header_type, granule, lacing, body)
+
+    def _flush_page(self, header_type, granule, lacing, body):
+        page = bytearray(OGG_PAGE.pack(b"OggS", 0, header_type, granule, self._serial,
+                                       self._sequence, 0, len(lacing)))
+        page += lacing + body
+        page[22:26] = struct.pack("<I", ogg_crc(bytes(page)))
+        self._out.write(page)
+        self._sequence += 1
+
+    def _append(self, data, name):
+        pages = list(iter_ogg_pages(data))
+        if not pages or not pages[0][3].startswith(b"OpusHead"):
+            raise ValueError(f"{name} is not an Ogg Opus stream")
+
+        # OpusHead is alone on the first page, and OpusTags ends the page
+        # its last segment is on; audio starts on the next page
+        headers = 1
+        while headers < len(pages):
+            headers += 1
+            if pages[headers - 1][2][-1:] != b"\xff":
+                break
+
+        if self._serial is None:
+            self._serial = zlib.crc32(str(self.output_file).encode("utf-8"))
+            self._pre_skip = struct.unpack_from("<H", pages[0][3], 10)[0]
+            self._check_sample_rate(OPUS_GRANULE_RATE, name)
+            for header_type, _, lacing, body in pages[:headers]:
+                self._write_page(header_type & OGG_CONTINUED | (OGG_FIRST if body.startswith(b"OpusHead") else 0),
+                                 0, lacing, body)
+
+        decoded = self._granule_offset
+        partial = b""
+        for header_type, granule, lacing, body in pages[headers:]:
+            finished, rest = split_packets(lacing, body)
+            if finished:
+                finished[0] = partial + finished[0]
+                partial = rest
+            else:
+                partial += rest
+            decoded += sum(opus_packet_samples(packet) for packet in finished)
+            self._write_page(header_type & OGG_CONTINUED, decoded if finished else -1, lacing, body)
+
+        last_granule = pages[-1][1]
+        if len(pages) > headers and last_granule != -1:
+            self._trimmed_end = min(decoded, self._granule_offset + last_granule)
+        else:
+            self._trimmed_end = decoded
+        self._granule_offset = decoded
+        self.samples = max(0, self._trimmed_end - self._pre_skip)
+
+    def _finalize(self):
+        header_type, granule, lacing, body = self._pending
+        self._flush_page(header_type | OGG_LAST, min(granule, self._trimmed_end), lacing, body)
+        self._pending = None
+
+# WAV, as local speech engines write it (and the speech endpoint can)
+def wav_chunks(data, name):
+    """
+    (fmt chunk body, PCM bytes) of a RIFF WAVE file. A data chunk whose
+    size was never filled in, as in streamed WAV, runs to the end of the file.
+    """
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{name} is not a WAV file")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = data[offset:offset + 4], struct.unpack_from("<I", data, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            fmt = data[body:body + size]
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError(f"{name} has no fmt chunk before its audio")
+            if size == 0 or body + size > len(data):
+                size = len(data) - body
+            return fmt, data[body:body + size]
+        offset = body + size + (size & 1)
+    raise ValueError(f"{name} has no audio data")
+
+class WavAssembler(ChunkAssembler):
+    """
+    WAV chunks: the PCM samples are copied into one data chunk and
+    finish() fills in the RIFF and data sizes. Every chunk must have the
+    same sample format.
+    """
+
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self._fmt = None
+        self._block_align = 1
+        self._data_size_offset = 0
+        self._data_bytes = 0
+
+    def _append(self, data, name):
+        fmt, pcm = wav_chunks(data, name)
+        if self._fmt is None:
+            self._fmt = fmt
+            sample_rate, _, self._block_align = struct.unpack_from("<IIH", fmt, 4)
+            self._check_sample_rate(sample_rate, name)
+            header = b"RIFF" + bytes(4) + b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+            header += bytes(len(fmt) & 1)
+            self._data_size_offset = len(header) + 4
+            self._out.write(header + b"data" + bytes(4))
+        elif fmt != self._fmt:
+            raise ValueError(f"{name} has a different sample format from the first chunk")
+        pcm = pcm[:len(pcm) - len(pcm) % self._block_align]
+        self._out.write(pcm)
+        self._data_bytes += len(pcm)
+        self.samples += len(pcm) // self._block_align
+
+    def _finalize(self):
+        if self._data_bytes & 1:
+            self._out.write(b"\0")
+        total = self._data_size_offset + 4 + self._data_bytes + (self._data_bytes & 1)
+        self._out.seek(4)
+        self._out.write(struct.pack("<I", total - 8))
+        self._out.seek(self._data_size_offset)
+        self._out.write(struct.pack("<I", self._data_bytes))
+
+# Output formats that chunks can be assembled from, by file extension
+AUDIO_FORMATS = {
+    "mp3": Mp3Assembler,
+    "opus": OggOpusAssembler,
+    "aac": AdtsAssembler,
+    "wav": WavAssembler,
+}
+
+def assembler_for(audio_format, output_file):
+    """The assembler for chunks in audio_format, writing output_file."""
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Cannot assemble '{audio_format}' audio; use one of {', '.join(AUDIO_FORMATS)}")
+    return AUDIO_FORMATS[audio_format](output_file)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def audio_report(path, duration):
+    """Duration, size and average bitrate of a finished audio file, for logs."""
+    size = os.path.getsize(path)
+    kbps = size * 8 / duration / 1000 if duration else 0
+    return f"{format_duration(duration)}, {size / 1048576:.1f} MB, {kbps:.0f} kbps"
+
+def assemble_files(chunk_files, output_file, audio_format=None):
+    """
+    Join existing chunk files, in the order given, into output_file. The
+    format defaults to output_file's extension.
+    """
+    audio_format = audio_format or Path(output_file).suffix.lstrip(".")
+    with assembler_for(audio_format, output_file) as assembler:
+        for number, chunk_file in enumerate(chunk_files, start=1):
+            assembler.add(number, chunk_file)
+        return assembler.finish(len(chunk_files))
+
+def main():
+    if len(sys.argv) < 3:
+        print(f"Usage: python audio_assemble.py <output.{{{','.join(AUDIO_FORMATS)}}}> <chunk_001> [chunk_002 ...]")
+        sys.exit(1)
+    assemble_files(sys.argv[2:], sys.argv[1])
+
+if __name__ == "__main__":
+    main()
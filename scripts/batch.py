@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+
+import anthropic
+
+import context
+import describe
+import figures
+from body import PaperCleaner
+from llm_cache import DEFAULT_CACHE_DIR, get_default_cache, message_entry, prompt_cache_stats
+from image_prep import image_prep_stats
+from manifest import Manifest, MANIFEST_NAME
+
+# Batches are checked this often while they run; most finish well within
+# the hour, and every one within 24 hours
+POLL_SECONDS = 60
+
+# Stay under the Message Batches limits of 100,000 requests and 256 MB
+# per batch. Figure requests carry base64 images, so size binds first.
+MAX_BATCH_REQUESTS = 10000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+# Submitted batches are recorded here so an interrupted run picks up
+# their results instead of paying for them again
+DEFAULT_STATE_PATH = DEFAULT_CACHE_DIR / "message_batches.json"
+
+class BatchRunner:
+    """
+    Sends Claude requests through the Message Batches API and stores each
+    result in the response cache under the same key messages.create would
+    use. The regular pipeline stages then find every response already
+    cached and write the usual artifacts without further Claude calls.
+    """
+
+    def __init__(self, client, state_path, cache=None, poll_seconds=POLL_SECONDS):
+        self.client = client
+        self.state_path = Path(state_path)
+        self.cache = cache or get_default_cache()
+        self.poll_seconds = poll_seconds
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.pending = json.load(f)
+        except (OSError, ValueError):
+            self.pending = {}
+
+    def _save(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.pending, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def submit(self, requests):
+        """
+        Submit every request that is neither cached nor already waiting in
+        a submitted batch. Returns the number of requests submitted.
+        """
+        waiting = {key for custom_ids in self.pending.values() for key in custom_ids.values()}
+        new = {}
+        for request in requests:
+            key = self.cache.key(request)
+            if key not in waiting and key not in new and not self.cache.contains(key):
+                new[key] = request
+
+        batch, batch_bytes = [], 0
+        for key, request in new.items():
+            size = len(json.dumps(request))
+            if batch and (len(batch) >= MAX_BATCH_REQUESTS or batch_bytes + size > MAX_BATCH_BYTES):
+                self._create(batch)
+                batch, batch_bytes = [], 0
+            batch.append((key, request))
+            batch_bytes += size
+        if batch:
+            self._create(batch)
+        return len(new)
+
+    def _create(self, batch):
+        # custom_id allows only 64 letters, digits, - and _, so the cache
+        # key is mapped from a short index instead of used directly
+        custom_ids = {f"req-{index:05d}": key for index, (key, _) in enumerate(batch)}
+        message_batch = self.client.messages.batches.create(requests=[
+            {"custom_id": custom_id, "params": request}
+            for custom_id, (_, request) in zip(custom_ids, batch)
+        ])
+        print(f"Submitted batch {message_batch.id} with {len(batch)} requests")
+        self.pending[message_batch.id] = custom_ids
+        self._save()
+
+    def wait(self):
+        """
+        Poll every pending batch until it ends and cache its results.
+        Returns the number of requests that did not succeed; those are
+        sent interactively by the regular stages.
+        """
+        failed = 0
+        for batch_id in list(self.pending):
+            message_batch = self.client.messages.batches.retrieve(batch_id)
+            while message_batch.processing_status != "ended":
+                counts = message_batch.request_counts
+                print(f"Batch {batch_id}: {counts.processing} processing, {counts.succeeded} succeeded")
+                time.sleep(self.poll_seconds)
+                message_batch = self.client.messages.batches.retrieve(batch_id)
+
+            custom_ids = self.pending[batch_id]
+            for response in self.client.messages.batches.results(batch_id):
+                key = custom_ids.get(response.custom_id)
+                if key is None:
+                    continue
+                if response.result.type == "succeeded":
+                    message = response.result.message
+                    entry = message_entry(message, message.model)
+                    prompt_cache_stats.record(entry["usage"])
+                    self.cache.put(key, entry)
+                else:
+                    print(f"Batch request {response.custom_id} {response.result.type}")
+                    failed += 1
+
+            print(f"Batch {batch_id} finished")
+            del self.pending[batch_id]
+            self._save()
+        return failed
+
+    def run(self, requests):
+        """Submit requests, wait for every pending batch and return the failure count."""
+        submitted = self.submit(requests)
+        print(f"{submitted} of {len(requests)} requests need a batch")
+        return self.wait()
+
+def prefill(work_dirs, client, cleaner, state_path=DEFAULT_STATE_PATH, poll_seconds=POLL_SECONDS, fused=False):
+    """
+    Fill the response cache for every paper in work_dirs in two rounds of
+    batches: figure descriptions and body cleaning first, then the figure
+    explanations that need those descriptions. In fused mode the figure
+    explanations do not depend on anything, so one round is enough.
+    """
+    runner = BatchRunner(client, state_path, poll_seconds=poll_seconds)
+    papers = []
+    for work_dir in work_dirs:
+        work_dir = Path(work_dir).resolve()
+        figs_dir = work_dir / "figs"
+        pdf_path = figs_dir / "paper.pdf"
+        if not pdf_path.exists():
+            print(f"Skipping {work_dir}: no figs/paper.pdf")
+            continue
+        papers.append((figs_dir, pdf_path, Manifest(work_dir / MANIFEST_NAME)))
+
+    print(f"Round 1: figure {'explanations' if fused else 'descriptions'} and body cleaning")
+    requests = []
+    for figs_dir, pdf_path, manifest in papers:
+        if fused:
+            requests += figures.fused_requests(context.read_pdf(str(pdf_path)), str(figs_dir))
+        else:
+            requests += [describe.build_request(path) for path in describe.list_figure_images(str(figs_dir))]
+        # The chunk plan is recorded in the manifest, so the pipeline run
+        # afterwards splits the body into exactly these chunks
+        chunks = cleaner.prepare_chunks(cleaner.extract_text(str(pdf_path)), manifest)
+        requests += cleaner.clean_requests(chunks)
+    failed = runner.run(requests)
+    if fused:
+        if failed:
+            print(f"{failed} batch requests failed and will be sent interactively")
+        return failed
+
+    # Write the *_blind.txt files from the cache; the explanations need them
+    for figs_dir, _, manifest in papers:
+        figures.describe_figures(str(figs_dir), manifest=manifest, client=client)
+
+    print("Round 2: figure explanations")
+    requests = []
+    for figs_dir, pdf_path, _ in papers:
+        requests += figures.context_requests(context.read_pdf(str(pdf_path)), str(figs_dir))
+    failed += runner.run(requests)
+
+    if failed:
+        print(f"{failed} batch requests failed and will be sent interactively")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prefill the response cache for prepared work directories through Message Batches'
+    )
+    parser.add_argument('work_dirs', nargs='+',
+                      help='Work directories containing figs/paper.pdf and the extracted figures')
+    parser.add_argument('--base-url',
+                      help='Anthropic API base URL, e.g. a local mock batch endpoint')
+    parser.add_argument('--state', default=str(DEFAULT_STATE_PATH),
+                      help=f'File recording submitted batches (default: {DEFAULT_STATE_PATH})')
+    parser.add_argument('--fused', action='store_true',
+                      help='Batch the fused figure explanation requests of pipeline.py --fused')
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS,
+                      help=f'Seconds between batch status checks (default: {POLL_SECONDS})')
+
+    args = parser.parse_args()
+    if not get_default_cache().enabled:
+        parser.error("batch mode stores its results in the response cache; unset WMC_NO_CACHE")
+
+    client = anthropic.Anthropic(base_url=args.base_url) if args.base_url else anthropic.Anthropic()
+    prefill(args.work_dirs, client, PaperCleaner(client=client), args.state, args.poll_seconds, args.fused)
+    print(prompt_cache_stats.summary())
+    print(image_prep_stats.summary())
+
+if __name__ == "__main__":
+    main()
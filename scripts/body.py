@@ -4,11 +4,16 @@ import re
 import anthropic
 import logging
 from pathlib import Path
-import pdfplumber
-from pytesseract import image_to_string
-from PIL import Image
+from typing import Iterator, List, Optional, Tuple
 import time
-import textwrap
+import json
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import create_message
+from chunking import ChunkBudget, estimate_tokens, pack_chunks, head_context, tail_context
+from pdf_text import load_text_model
+from manifest import Manifest, hash_inputs
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,17 +22,71 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+CLEAN_MODEL = "claude-3-5-sonnet-20241022"
+CLEAN_MAX_TOKENS = 8192
+
+# Chunks cleaned at once, and how much neighbouring text each request sees
+DEFAULT_CLEAN_CONCURRENCY = 4
+DEFAULT_CLEAN_INPUT_TOKENS = 5000
+OVERLAP_TOKENS = 150
+
+CLEAN_PROMPT = """Clean this scientific text by removing metadata and formatting while preserving scientific content. Remove citations, references, headers, footers, page numbers, and formatting artifacts.  Maintain all technical details and data. Return ONLY the cleaned text with no additional commentary or metadata. 
+            Additionally, please spell out the full words for any use of acronyms and please describe in spoken language any math equations or scientific notations to the best of your ability. This is for a listening audience via text-to-speech so the outputs must all be easily interpreted by a TTS engine. 
+Again, please adhere to the original text. Do not mention this prompt. 
+
+Scientific Text:
+
+{chunk}. """
+
+# Neighbouring text given to the model for continuity across chunk seams
+CONTEXT_PROMPT = """
+
+For continuity only, here is the text immediately surrounding the scientific text above. Do not clean, repeat or include it in your output.
+
+Preceding text:
+{before}
+
+Following text:
+{after}"""
+
+def build_clean_prompt(chunk: str, before: str = "", after: str = "") -> str:
+    """Cleaning prompt for a chunk, with its neighbouring text when there is any."""
+    prompt = CLEAN_PROMPT.format(chunk=chunk)
+    if before or after:
+        prompt += CONTEXT_PROMPT.format(before=before or "(start of paper)", after=after or "(end of paper)")
+    return prompt
+
+def build_clean_request(chunk: str, before: str = "", after: str = "") -> dict:
+    """The messages.create request that cleans one chunk."""
+    return {
+        "model": CLEAN_MODEL,
+        "max_tokens": CLEAN_MAX_TOKENS,
+        "messages": [{"role": "user", "content": build_clean_prompt(chunk, before, after)}]
+    }
+
+def clean_budget(max_input_tokens: int = DEFAULT_CLEAN_INPUT_TOKENS,
+                 target_latency: Optional[float] = None) -> ChunkBudget:
+    """
+    The chunk budget for cleaning requests: at most max_input_tokens per
+    chunk, shrinking while requests take longer than target_latency seconds.
+    """
+    return ChunkBudget(max_input_tokens=max_input_tokens, max_output_tokens=CLEAN_MAX_TOKENS,
+                       min_input_tokens=min(500, max_input_tokens), target_latency=target_latency)
+
 class PaperCleaner:
-    def __init__(self):
-        self.client = anthropic.Anthropic()
+    def __init__(self, client=None, budget: Optional[ChunkBudget] = None,
+                 concurrency: int = DEFAULT_CLEAN_CONCURRENCY):
+        self.client = client if client is not None else anthropic.Anthropic()
+        self.budget = budget if budget is not None else clean_budget()
+        self.concurrency = max(1, concurrency)
         
-    def clean_paper(self, text: str) -> str:
+    def clean_paper(self, text: str, manifest: Optional[Manifest] = None) -> str:
         """Clean the paper text by removing metadata and formatting."""
         # First apply basic cleaning
         text = self._basic_cleanup(text)
         
         # Then use Claude for more sophisticated cleaning
-        cleaned = self._process_with_claude(text)
+        cleaned = self._process_with_claude(text, manifest)
         return cleaned
         
     def _basic_cleanup(self, text: str) -> str:
@@ -52,64 +111,160 @@ class PaperCleaner:
         
         # Fix formatting
         text = re.sub(r'- ([a-z])', r'\1', text)  # Fix hyphenation
-        text = re.sub(r'\s+', ' ', text)  # Normalize whitespace
-        text = re.sub(r' +', ' ', text)  # Remove multiple spaces
         
-        return text.strip()
+        # Normalize whitespace within paragraphs, keeping paragraph breaks
+        # so the chunker can split on them
+        paragraphs = [re.sub(r'\s+', ' ', p).strip() for p in re.split(r'\n\s*\n', text)]
+        text = "\n\n".join(p for p in paragraphs if p)
         
-    def _process_with_claude(self, text: str) -> str:
-        """Use Claude to clean and format the text, handling text in chunks."""
-        # Split text into chunks of roughly 4000 characters (leaving room for prompt)
-        chunks = textwrap.wrap(text, 4000, break_long_words=False, break_on_hyphens=False)
-        cleaned_chunks = []
+        return text.strip()
         
-        for chunk in chunks:
-            prompt = f"""Clean this scientific text by removing metadata and formatting while preserving scientific content. Remove citations, references, headers, footers, page numbers, and formatting artifacts.  Maintain all technical details and data. Return ONLY the cleaned text with no additional commentary or metadata. 
-            Additionally, please spell out the full words for any use of acronyms and please describe in spoken language any math equations or scientific notations to the best of your ability. This is for a listening audience via text-to-speech so the outputs must all be easily interpreted by a TTS engine. 
-Again, please adhere to the original text. Do not mention this prompt. 
+    def prepare_chunks(self, text: str, manifest: Optional[Manifest] = None) -> List[str]:
+        """Apply basic cleanup and split the text into the chunks sent to Claude."""
+        return self._plan_chunks(self._basic_cleanup(text), manifest)
 
-Scientific Text:
+    def _plan_chunks(self, text: str, manifest: Optional[Manifest] = None) -> List[str]:
+        """
+        Split text into chunks at the current token budget. The budget adapts
+        between papers, so the one used for a paper is recorded in its
+        manifest and reused on a rerun to reproduce the same chunks.
+        """
+        input_hash = hash_inputs(text)
+        max_tokens = None
+        if manifest is not None:
+            plan = manifest.get_result("clean:plan", input_hash)
+            if plan is not None:
+                max_tokens = json.loads(plan)["max_tokens"]
+        if max_tokens is None:
+            max_tokens = self.budget.chunk_tokens()
+            if manifest is not None:
+                manifest.mark_done("clean:plan", input_hash, result=json.dumps({"max_tokens": max_tokens}))
+
+        chunks = self._split_chunks(text, max_tokens)
+        logger.info(f"Split text into {len(chunks)} chunks of up to {max_tokens} tokens")
+        return chunks
+
+    def iter_clean_chunks(self, chunks: List[str], manifest: Optional[Manifest] = None) -> Iterator[str]:
+        """
+        Clean chunks concurrently (up to self.concurrency at once) and yield
+        them in their original order, each as soon as it and every chunk
+        before it are done, so later stages can start on them.
+
+        Only 2 * concurrency chunks are submitted ahead of the one being
+        consumed, so a consumer that stops early (or fails) does not leave
+        the rest of the paper being cleaned; requests not yet started when
+        the generator is closed are cancelled.
+        """
+        jobs = enumerate(zip(chunks, self._context_windows(chunks)))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            def submit(count):
+                for index, (chunk, (before, after)) in islice(jobs, count):
+                    pending.append(executor.submit(self._clean_chunk, chunk, index, manifest, before, after))
 
-{chunk}. """
             try:
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=8192,
-                    messages=[{"role": "user", "content": prompt}]
+                submit(2 * self.concurrency)
+                while pending:
+                    cleaned = pending.popleft().result()
+                    submit(1)
+                    yield cleaned
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def clean_requests(self, chunks: List[str]) -> List[dict]:
+        """The requests iter_clean_chunks would send for these chunks, for batch submission."""
+        return [
+            build_clean_request(chunk, before, after)
+            for chunk, (before, after) in zip(chunks, self._context_windows(chunks))
+        ]
+
+    def _context_windows(self, chunks: List[str], before: str = "", after: str = "") -> List[Tuple[str, str]]:
+        """(preceding, following) text for each chunk, a few sentences from its neighbours."""
+        windows = []
+        for index in range(len(chunks)):
+            previous = tail_context(chunks[index - 1], OVERLAP_TOKENS) if index > 0 else before
+            following = head_context(chunks[index + 1], OVERLAP_TOKENS) if index + 1 < len(chunks) else after
+            windows.append((previous, following))
+        return windows
+
+    def _split_chunks(self, text: str, max_tokens: Optional[int] = None) -> List[str]:
+        """Pack text into chunks near the token budget, split on section, paragraph and sentence boundaries."""
+        return pack_chunks(text, max_tokens or self.budget.chunk_tokens())
+
+    def _request_clean(self, chunk: str, before: str = "", after: str = "") -> str:
+        """
+        Send one chunk to Claude. If the response is cut off at max_tokens,
+        the chunk is split in two and each half cleaned separately.
+        """
+        start = time.monotonic()
+        response = create_message(self.client, build_clean_request(chunk, before, after))
+        latency = None if response["cached"] else time.monotonic() - start
+
+        usage = response.get("usage") or {}
+        output_tokens = usage.get("output_tokens") or estimate_tokens(response["text"])
+        truncated = response.get("stop_reason") == "max_tokens"
+        self.budget.observe(estimate_tokens(chunk), output_tokens, latency, truncated)
+
+        if truncated:
+            halves = pack_chunks(chunk, estimate_tokens(chunk) // 2 + 1)
+            if len(halves) > 1:
+                logger.warning(f"Cleaned chunk hit max_tokens, retrying as {len(halves)} smaller chunks")
+                windows = self._context_windows(halves, before, after)
+                return "\n\n".join(
+                    self._request_clean(half, *window) for half, window in zip(halves, windows)
                 )
-                
-                if response and response.content:
-                    if isinstance(response.content, list):
-                        cleaned_text = response.content[0].text.strip()
-                    else:
-                        cleaned_text = response.content.strip()
-                    
-                    # Remove any added commentary
-                    cleaned_text = re.sub(r'^Here\'s.*?:\n*', '', cleaned_text)
-                    cleaned_chunks.append(cleaned_text)
-                
-                # Add small delay between API calls
-                time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Error cleaning text chunk: {e}")
-                cleaned_chunks.append(chunk)
+
+        # Remove any added commentary
+        return re.sub(r'^Here\'s.*?:\n*', '', response["text"].strip())
+
+    def _clean_chunk(self, chunk: str, index: int = 0, manifest: Optional[Manifest] = None,
+                     before: str = "", after: str = "") -> str:
+        """
+        Clean a single chunk with Claude, falling back to the raw chunk on error.
+        With a manifest, a chunk already cleaned from the same text is reused,
+        and only successfully cleaned chunks are recorded.
+        """
+        prompt = build_clean_prompt(chunk, before, after)
+        unit = f"clean:{index + 1:03d}"
+        input_hash = hash_inputs(prompt)
+        if manifest is not None:
+            cleaned_text = manifest.get_result(unit, input_hash)
+            if cleaned_text is not None:
+                return cleaned_text
+
+        try:
+            cleaned_text = self._request_clean(chunk, before, after)
+            
+            if manifest is not None:
+                manifest.mark_done(unit, input_hash, result=cleaned_text)
+            return cleaned_text
             
-        return "\n\n".join(cleaned_chunks)
+        except Exception as e:
+            logger.error(f"Error cleaning text chunk: {e}")
+            return chunk
+
+    def _process_with_claude(self, text: str, manifest: Optional[Manifest] = None) -> str:
+        """Use Claude to clean and format the text, handling text in chunks."""
+        cleaned_chunks = list(self.iter_clean_chunks(self._plan_chunks(text, manifest), manifest))
+        return "\n\n".join(chunk for chunk in cleaned_chunks if chunk)
+
+    def extract_text(self, pdf_path: str) -> str:
+        """Extract the raw text of every page that has any, one text block per paragraph."""
+        raw_text = ""
+        for page in load_text_model(pdf_path)["pages"]:
+            for block in page["blocks"]:
+                raw_text += block["text"].strip() + "\n\n"
+        return raw_text
             
-    def process_pdf(self, pdf_path: str) -> str:
+    def process_pdf(self, pdf_path: str, manifest: Optional[Manifest] = None) -> str:
         """Extract and clean text from a PDF file."""
         try:
             # Extract text from PDF
-            raw_text = ""
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        raw_text += text + "\n"
+            raw_text = self.extract_text(pdf_path)
             
             # Clean the extracted text
-            cleaned_text = self.clean_paper(raw_text)
+            cleaned_text = self.clean_paper(raw_text, manifest)
             return cleaned_text
             
         except Exception as e:
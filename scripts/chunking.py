@@ -0,0 +1,166 @@
+import re
+import threading
+
+# Claude has no local tokenizer; English scientific prose averages roughly
+# 3.5 characters per token, which is close enough for packing requests.
+CHARS_PER_TOKEN = 3.5
+
+# Boundary strengths, strongest first. A chunk is preferably cut at the
+# strongest boundary that still leaves it reasonably full.
+SECTION, PARAGRAPH, SENTENCE, WORD = 3, 2, 1, 0
+
+SECTION_NAMES = (
+    "abstract", "introduction", "background", "results", "discussion",
+    "conclusion", "conclusions", "methods", "materials and methods",
+    "experimental procedures", "acknowledgements", "acknowledgments",
+    "references", "supplementary information", "data availability"
+)
+
+# Numbered headings such as "2 Results" or "3.1. Cell culture"
+NUMBERED_HEADING = re.compile(r'^\d+(\.\d+)*\.?\s+[A-Z][^.!?]{0,80}$')
+
+# Sentence ends followed by a capital letter or bracket. Digits are excluded
+# so "Fig. 2" and decimals are not split.
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z(\[])')
+
+def estimate_tokens(text):
+    """Approximate token count of a piece of text."""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def is_heading(paragraph):
+    """Short lines that name a section or carry a section number."""
+    stripped = paragraph.strip()
+    if len(stripped) > 80 or stripped.endswith(('.', ',', ';', ':')):
+        return False
+    return stripped.lower().rstrip(':') in SECTION_NAMES or bool(NUMBERED_HEADING.match(stripped))
+
+def split_units(text, max_tokens):
+    """
+    Break text into (strength, unit) pairs, where strength is the kind of
+    boundary before the unit. Paragraphs are kept whole when they fit in
+    max_tokens and split into sentences, then words, only when they do not.
+    """
+    units = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        strength = SECTION if is_heading(paragraph) else PARAGRAPH
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append((strength, paragraph))
+            continue
+
+        for sentence in SENTENCE_END.split(paragraph):
+            if estimate_tokens(sentence) <= max_tokens:
+                units.append((strength, sentence))
+            else:
+                words = sentence.split(' ')
+                step = max(1, int(max_tokens * CHARS_PER_TOKEN / 8))  # ~8 chars per word
+                for start in range(0, len(words), step):
+                    units.append((strength, ' '.join(words[start:start + step])))
+                    strength = WORD
+            strength = SENTENCE
+    return units
+
+def join_units(units):
+    """Rebuild text from units, keeping paragraph breaks."""
+    parts = []
+    for strength, unit in units:
+        if parts:
+            parts.append("\n\n" if strength >= PARAGRAPH else " ")
+        parts.append(unit)
+    return "".join(parts)
+
+def pack_chunks(text, max_tokens, min_fill=0.6):
+    """
+    Pack text into as few chunks as possible of at most max_tokens each.
+    When a chunk fills up, it is cut at the strongest boundary (section,
+    then paragraph, then sentence) that keeps it at least min_fill full.
+    """
+    chunks = []
+    current = []
+    current_tokens = []
+
+    for strength, unit in split_units(text, max_tokens):
+        tokens = estimate_tokens(unit)
+        if current and sum(current_tokens) + tokens > max_tokens:
+            # Find the strongest boundary in the chunk's back portion
+            best = len(current)
+            best_strength = strength
+            filled = 0
+            for i in range(1, len(current)):
+                filled += current_tokens[i - 1]
+                if filled >= max_tokens * min_fill and current[i][0] > best_strength:
+                    best, best_strength = i, current[i][0]
+            chunks.append(join_units(current[:best]))
+            current, current_tokens = current[best:], current_tokens[best:]
+            if current and sum(current_tokens) + tokens > max_tokens:
+                chunks.append(join_units(current))
+                current, current_tokens = [], []
+
+        current.append((strength, unit))
+        current_tokens.append(tokens)
+
+    if current:
+        chunks.append(join_units(current))
+    return chunks
+
+def head_context(text, max_tokens):
+    """Whole sentences from the start of text, up to max_tokens."""
+    window = ""
+    for sentence in SENTENCE_END.split(text.strip()):
+        if window and estimate_tokens(window + " " + sentence) > max_tokens:
+            break
+        window = (window + " " + sentence).strip()
+    return window if estimate_tokens(window) <= max_tokens else ""
+
+def tail_context(text, max_tokens):
+    """Whole sentences from the end of text, up to max_tokens."""
+    window = ""
+    for sentence in reversed(SENTENCE_END.split(text.strip())):
+        if window and estimate_tokens(sentence + " " + window) > max_tokens:
+            break
+        window = (sentence + " " + window).strip()
+    return window if estimate_tokens(window) <= max_tokens else ""
+
+class ChunkBudget:
+    """
+    How many input tokens to put in each cleaning request.
+
+    The budget stays below max_input_tokens and leaves room for the cleaned
+    text within max_output_tokens, using the observed output/input ratio
+    (cleaning spells out acronyms and equations, so output runs longer than
+    input). It shrinks after a response hits max_tokens and grows back
+    while responses come back complete. With a target_latency it also
+    shrinks when requests are slower than that.
+    """
+
+    def __init__(self, max_input_tokens=5000, max_output_tokens=8192, min_input_tokens=500,
+                 expansion=1.3, target_latency=None):
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.min_input_tokens = min_input_tokens
+        self.expansion = expansion
+        self.target_latency = target_latency
+        self.input_tokens = max_input_tokens
+        self._lock = threading.Lock()
+
+    def chunk_tokens(self):
+        """Current input token budget per chunk."""
+        with self._lock:
+            # Keep 10% headroom so a slightly wordier response is not cut off
+            output_cap = int(self.max_output_tokens * 0.9 / max(self.expansion, 1.0))
+            return max(self.min_input_tokens, min(self.input_tokens, output_cap))
+
+    def observe(self, input_tokens, output_tokens, latency=None, truncated=False):
+        """Update the budget from one finished request."""
+        with self._lock:
+            if input_tokens:
+                ratio = output_tokens / input_tokens
+                self.expansion = 0.7 * self.expansion + 0.3 * ratio
+            if truncated:
+                self.input_tokens = max(self.min_input_tokens, int(self.input_tokens * 0.7))
+            elif self.target_latency and latency and latency > self.target_latency:
+                self.input_tokens = max(self.min_input_tokens, int(self.input_tokens * 0.85))
+            else:
+                self.input_tokens = min(self.max_input_tokens, int(self.input_tokens * 1.1))
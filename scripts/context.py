@@ -1,20 +1,18 @@
 import os
 import sys
 import anthropic
-import PyPDF2
+import describe
+from pdf_text import read_pdf_text
+from figure_index import figure_context
+from llm_cache import create_text, cacheable_text
 
 def read_pdf(pdf_path):
     """Extract text from PDF file."""
     try:
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
+        return read_pdf_text(pdf_path)
     except Exception as e:
         print(f"Error reading PDF: {e}")
-        sys.exit(1)
+        raise
 
 def read_description(desc_path):
     """Read the figure description from text file."""
@@ -23,71 +21,158 @@ def read_description(desc_path):
             return file.read().strip()
     except Exception as e:
         print(f"Error reading description file: {e}")
-        sys.exit(1)
-
-def get_contextual_explanation(paper_text, figure_desc, figure_number, full_figure_desc=None):
-    """Get contextual explanation from Claude."""
-    client = anthropic.Anthropic()
-    
+        raise
+
+PANEL_INSTRUCTIONS = """Here is a scientific paper's content and a description of a panel of one of its figures.
+Please provide a detailed explanation of this panel as if presenting to a blind journal club audience. Do not mention this.
+Focus on the following:
+
+Describe the layout of the panel and any axes and their labels.
+Paint a picture in the listener's mind of the panel.
+The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
+Key findings or patterns visible in the if they are necessary for understanding.
+Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
+
+The paper text, full figure, and panel are provided. Please only discuss the panel. The other two are provided only for your understanding and context."""
+
+FIGURE_INSTRUCTIONS = """Here is a scientific paper's content and a description of one of its figures.
+Please provide a detailed explanation of this figure as if presenting to a blind journal club audience. Do not mention this.
+Focus on the following:
+
+Describe the layout of the figure and any axes and their labels.
+Paint a picture in the listener's mind of the figure.
+The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
+Key findings or patterns visible in the figure.
+Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
+
+The paper text and figure are provided. Please only discuss the figure. The paper is only provided only for your understanding and context."""
+
+def build_request(paper_text, figure_desc, figure_number, full_figure_desc=None):
+    """
+    The messages.create request for a figure or panel explanation. Only the
+    caption and passages of paper_text that discuss the figure are sent.
+
+    Stable parts come first so Claude's prompt cache can reuse them: the
+    instructions in the system prompt, then for a panel the paper passages
+    and full figure description, which are the same for every panel of the
+    figure. Only the last block differs between requests.
+    """
+    excerpt = figure_context(paper_text, figure_number)
     if full_figure_desc:
-        prompt = f"""Here is a scientific paper's content and a description of a panel of Figure {figure_number}. 
-        Please provide a detailed explanation of this panel as if presenting to a blind journal club audience. Do not mention this.
-        Focus on the following:
-
-        Describe the layout of the panel and any axes and their labels.
-        Paint a picture in the listener's mind of the panel.
-        The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
-        Key findings or patterns visible in the if they are necessary for understanding.
-        Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
-
-        The paper text, full figure, and panel are provided. Please only discuss the panel. The other two are provided only for your understanding and context.
-
-        Paper text:
-        {paper_text[:5000]}... 
-
-        Full Figure {figure_number} description:
-        {full_figure_desc}
-
-        Panel description:
-        {figure_desc}
-        """
+        system = PANEL_INSTRUCTIONS
+        content = [
+            cacheable_text(
+                f"Paper text:\n{excerpt}...\n\n"
+                f"Full Figure {figure_number} description:\n{full_figure_desc}"
+            ),
+            {"type": "text", "text": f"Panel description (a panel of Figure {figure_number}):\n{figure_desc}"}
+        ]
     else:
-        prompt = f"""Here is a scientific paper's content and a description of Figure {figure_number}. 
-        Please provide a detailed explanation of this figure as if presenting to a blind journal club audience. Do not mention this.
-        Focus on the following:
-
-        Describe the layout of the figure and any axes and their labels.
-        Paint a picture in the listener's mind of the figure.
-        The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
-        Key findings or patterns visible in the figure.
-        Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
-
-        The paper text and figure are provided. Please only discuss the figure. The paper is only provided only for your understanding and context.
-
-        Paper text:
-        {paper_text[:5000]}... 
-
-        Figure {figure_number} description:
-        {figure_desc}
-        """
+        system = FIGURE_INSTRUCTIONS
+        content = f"Paper text:\n{excerpt}...\n\nFigure {figure_number} description:\n{figure_desc}"
+
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 8000,
+        "system": [cacheable_text(system)],
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    }
+
+FUSED_DETAILED_INSTRUCTIONS = """Here is a scientific paper's content, an image of one of its figures, and images of panels of that figure, each labelled with its panel number.
+Study each panel closely: its layout, axes and labels, legends, color coding, numerical values, scales, symbols and any text in it.
+Then please provide a detailed explanation of each panel, in the order given, as if presenting to a blind journal club audience. Do not mention this.
+For each panel, focus on the following:
+
+Describe the layout of the panel and any axes and their labels.
+Paint a picture in the listener's mind of the panel.
+The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
+Key findings or patterns visible in the if they are necessary for understanding.
+Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
+
+The paper text and full figure are provided only for your understanding and context. Please only discuss the panels, and let each explanation flow on from the one before.
+Start each panel's explanation on its own line with "Panel N:", where N is the panel number, and write nothing before the first panel."""
+
+FUSED_FIGURE_INSTRUCTIONS = """Here is a scientific paper's content and an image of one of its figures.
+Study the figure closely: its panels, axes and labels, legends, color coding, numerical values, scales, symbols and any text or caption in it.
+Then please provide a detailed explanation of this figure as if presenting to a blind journal club audience. Do not mention this.
+Focus on the following:
+
+Describe the layout of the figure and any axes and their labels.
+Paint a picture in the listener's mind of the figure.
+The user does not have the paper in front of them so cannot see the pictures, they can only hear your words. 
+Key findings or patterns visible in the figure.
+Maintain scientific detail, rigor and accuracy. Take your time. Use as many tokens as you need.
+
+The paper text and figure are provided. Please only discuss the figure. The paper is only provided only for your understanding and context."""
+
+def build_fused_request(paper_text, image_path, figure_number):
+    """
+    A single request that looks at the figure image itself and explains it
+    in context, instead of explaining a separate describe.py description.
+    """
+    excerpt = figure_context(paper_text, figure_number)
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 8000,
+        "system": [cacheable_text(FUSED_FIGURE_INSTRUCTIONS)],
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"Paper text:\n{excerpt}...\n\nFigure {figure_number}:"},
+                    describe.image_block(image_path)
+                ]
+            }
+        ]
+    }
+
+def build_detailed_request(paper_text, figure_number, full_image_path, panels):
+    """
+    One request for several panels of a detailed figure: the full figure
+    image followed by each (panel_number, image_path) in panels. The paper
+    passages and full image come first and are marked for prompt caching,
+    so a follow-up request for the remaining panels reuses them.
+    """
+    excerpt = figure_context(paper_text, figure_number)
+    full_image = describe.image_block(full_image_path)
+    full_image["cache_control"] = {"type": "ephemeral"}
+    content = [
+        {"type": "text", "text": f"Paper text:\n{excerpt}...\n\nFull Figure {figure_number}:"},
+        full_image
+    ]
+    for panel_number, image_path in panels:
+        content.append({"type": "text", "text": f"Panel {panel_number}:"})
+        content.append(describe.image_block(image_path))
+
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 8192,
+        "system": [cacheable_text(FUSED_DETAILED_INSTRUCTIONS)],
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    }
+
+def get_contextual_explanation(paper_text, figure_desc, figure_number, full_figure_desc=None, client=None):
+    """Get contextual explanation from Claude."""
+    if client is None:
+        client = anthropic.Anthropic()
 
     try:
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=8000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        )
-        return message.content[0].text
+        return create_text(client, build_request(paper_text, figure_desc, figure_number, full_figure_desc))
     except Exception as e:
         print(f"Error getting explanation from Claude: {e}")
         if hasattr(e, 'response') and hasattr(e.response, 'text'):
             print(f"Detailed error: {e.response.text}")
-        sys.exit(1)
+        raise
 
 def save_explanation(explanation, output_path):
     """Save the contextual explanation to a file."""
@@ -97,7 +182,7 @@ def save_explanation(explanation, output_path):
         print(f"\nContextual explanation saved to: {output_path}")
     except Exception as e:
         print(f"Error saving explanation to file: {e}")
-        sys.exit(1)
+        raise
 
 def extract_figure_number(filename):
     """Extract figure number from filename."""
@@ -133,20 +218,23 @@ def main():
         print(f"Error: Full figure description file '{full_desc_path}' does not exist.")
         sys.exit(1)
 
-    # Read input files
-    paper_text = read_pdf(pdf_path)
-    figure_desc = read_description(desc_path)
-    full_figure_desc = read_description(full_desc_path) if full_desc_path else None
-    
-    # Get figure number from filename
-    figure_number = extract_figure_number(os.path.basename(desc_path))
+    try:
+        # Read input files
+        paper_text = read_pdf(pdf_path)
+        figure_desc = read_description(desc_path)
+        full_figure_desc = read_description(full_desc_path) if full_desc_path else None
+
+        # Get figure number from filename
+        figure_number = extract_figure_number(os.path.basename(desc_path))
 
-    # Get contextual explanation
-    explanation = get_contextual_explanation(paper_text, figure_desc, figure_number, full_figure_desc)
+        # Get contextual explanation
+        explanation = get_contextual_explanation(paper_text, figure_desc, figure_number, full_figure_desc)
 
-    # Generate output filename and save explanation
-    output_path = os.path.splitext(desc_path)[0] + "_contextual.txt"
-    save_explanation(explanation, output_path)
+        # Generate output filename and save explanation
+        output_path = os.path.splitext(desc_path)[0] + "_contextual.txt"
+        save_explanation(explanation, output_path)
+    except Exception:
+        sys.exit(1)
 
     # Also print to console
     print("\nContextual Figure Explanation:")
@@ -14,8 +14,10 @@ if [ ! -f "$PAPER_PATH" ]; then
     exit 1
 fi
 
-# Directory containing figures
-FIGS_DIR="figs"
+# Figures live next to the paper, and the Python scripts next to this script,
+# so descon.sh can run from any directory
+FIGS_DIR="$(dirname "$PAPER_PATH")"
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
 
 # Check if figures directory exists
 if [ ! -d "$FIGS_DIR" ]; then
@@ -23,29 +25,19 @@ if [ ! -d "$FIGS_DIR" ]; then
     exit 1
 fi
 
+# FUSED=1 explains each figure image directly in one request per image,
+# with no describe step for the explanations to wait on
+if [ -n "$FUSED" ]; then
+    echo "Explaining all figures in fused mode..."
+    python "$SCRIPT_DIR"/figures.py "$PAPER_PATH" --fused --concurrency "${DESCRIBE_CONCURRENCY:-8}"
+    exit $?
+fi
+
 echo "Step 1: Processing all figures with describe.py..."
 echo "----------------------------------------"
 
-# First, process all figures to generate descriptions
-for fig in "$FIGS_DIR"/figure_*.png; do
-    if [ -f "$fig" ]; then
-        # Skip panel files in this initial pass
-        if [[ ! "$fig" == *"panel"* ]]; then
-            echo "Processing figure: $fig"
-            python ../../scripts/describe.py "$fig"
-            sleep 1
-        fi
-    fi
-done
-
-# Then process all panels
-for fig in "$FIGS_DIR"/figure_*_panel_*.png; do
-    if [ -f "$fig" ]; then
-        echo "Processing panel: $fig"
-        python ../../scripts/describe.py "$fig"
-        sleep 1
-    fi
-done
+# Describe all figures and panels concurrently; each *_blind.txt is written as its response arrives
+python "$SCRIPT_DIR"/describe.py "$FIGS_DIR" --concurrency "${DESCRIBE_CONCURRENCY:-8}"
 
 echo -e "\nStep 2: Creating contextual descriptions..."
 echo "----------------------------------------"
@@ -61,7 +53,7 @@ process_detailed_figure() {
     for panel_desc in "$FIGS_DIR"/figure_${base_num}_panel_*_blind.txt; do
         if [ -f "$panel_desc" ]; then
             echo "Processing detailed figure ${base_num} with panel: $panel_desc"
-            python ../../scripts/context.py "$PAPER_PATH" "$panel_desc" "$full_desc"
+            python "$SCRIPT_DIR"/context.py "$PAPER_PATH" "$panel_desc" "$full_desc"
             sleep 1
         fi
     done
@@ -90,7 +82,7 @@ for desc in "$FIGS_DIR"/figure_*_blind.txt; do
         # Process regular figures (not panels or full figures)
         elif [[ ! "$desc" == *"_panel_"* ]] && [[ ! "$desc" == *"_full_"* ]]; then
             echo "Processing regular figure: $desc"
-            python ../../scripts/context.py "$PAPER_PATH" "$desc"
+            python "$SCRIPT_DIR"/context.py "$PAPER_PATH" "$desc"
             sleep 1
         fi
     fi
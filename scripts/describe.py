@@ -2,38 +2,13 @@ import os
 import sys
 import base64
 import anthropic
-import mimetypes
+import glob
+import asyncio
+import argparse
+from llm_cache import create_text, acreate_text, cacheable_text
+from image_prep import prepare_image
 
-def get_mime_type(file_path):
-    """
-    Get the MIME type of the file based on its extension.
-    """
-    mime_type, _ = mimetypes.guess_type(file_path)
-    if mime_type is None:
-        # Default to jpeg if we can't determine the type
-        mime_type = 'image/jpeg'
-    return mime_type
-
-def encode_image(image_path):
-    """
-    Encode an image file to base64.
-    """
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        print(f"Error encoding image: {e}")
-        sys.exit(1)
-
-def describe_image(image_path):
-    """
-    Send a scientific figure to Claude and get a comprehensive, technical description.
-    """
-    client = anthropic.Anthropic()
-    base64_image = encode_image(image_path)
-    mime_type = get_mime_type(image_path)
-    
-    prompt = """Please provide an extremely detailed analysis of this scientific figure, following this structured approach:
+DESCRIBE_PROMPT = """Please provide an extremely detailed analysis of this scientific figure, following this structured approach:
 
 1. Figure Overview
 - Identify the figure number and title if present
@@ -77,37 +52,131 @@ def describe_image(image_path):
 
 Please provide complete technical detail, maintaining scientific precision. Use exact terminology and capture all numerical values, labels, and relationships precisely. List every labeled element and describe all visual representations of data or processes."""
 
+# How many describe requests may be in flight at once in batch mode
+DEFAULT_CONCURRENCY = 8
+
+def image_block(image_path):
+    """
+    A base64 image content block for a figure image, resized to the vision
+    model's pixel budget and in the most compact lossless format.
+    """
+    media_type, data = prepare_image(image_path)
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": media_type,
+            "data": base64.b64encode(data).decode('utf-8')
+        }
+    }
+
+def build_request(image_path):
+    """
+    Build the messages.create arguments for describing one figure image.
+    The instructions are the same for every image, so they go first, in
+    the system prompt, as a cacheable prefix; only the image varies.
+    """
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 4000,
+        "system": [cacheable_text(DESCRIBE_PROMPT)],
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    image_block(image_path),
+                    {
+                        "type": "text",
+                        "text": "Please analyze this scientific figure."
+                    }
+                ]
+            }
+        ]
+    }
+
+def describe_image(image_path, client=None):
+    """
+    Send a scientific figure to Claude and get a comprehensive, technical description.
+    """
+    if client is None:
+        client = anthropic.Anthropic()
+    request = build_request(image_path)
+
     try:
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=4000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": base64_image
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
-                }
-            ]
-        )
-        return message.content[0].text
+        return create_text(client, request)
         
     except Exception as e:
         print(f"Error getting description from Claude: {e}")
         if hasattr(e, 'response') and hasattr(e.response, 'text'):
             print(f"Detailed error: {e.response.text}")
-        sys.exit(1)
+        raise
+
+async def describe_image_async(image_path, client, semaphore):
+    """
+    Describe one figure with the async client, waiting on the semaphore so
+    only a bounded number of requests are in flight, and write its
+    *_blind.txt as soon as the response arrives. The image is prepared
+    only once a slot is free, and in a worker thread, so the event loop is
+    not blocked and at most `concurrency` payloads are held at once.
+    """
+    async with semaphore:
+        request = await asyncio.to_thread(build_request, image_path)
+        try:
+            description = await acreate_text(client, request)
+        except Exception as e:
+            print(f"Error getting description for {image_path} from Claude: {e}")
+            if hasattr(e, 'response') and hasattr(e.response, 'text'):
+                print(f"Detailed error: {e.response.text}")
+            raise
+    output_path = get_output_filename(image_path)
+    save_description(description, output_path)
+    return output_path
+
+def async_client(client=None):
+    """
+    An AsyncAnthropic with the same API key and base URL as a synchronous
+    client, so the describe stage talks to the endpoint the rest of the
+    pipeline was configured with.
+    """
+    if client is None:
+        return anthropic.AsyncAnthropic()
+    return anthropic.AsyncAnthropic(api_key=client.api_key, base_url=client.base_url)
+
+async def describe_images_async(image_paths, concurrency=DEFAULT_CONCURRENCY, client=None):
+    """
+    Describe all images concurrently, at most `concurrency` at a time.
+    Returns {image_path: output_path or the exception raised for it}.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    owns_client = client is None
+    if owns_client:
+        client = async_client()
+    try:
+        results = await asyncio.gather(
+            *(describe_image_async(path, client, semaphore) for path in image_paths),
+            return_exceptions=True
+        )
+    finally:
+        if owns_client:
+            await client.close()
+    return dict(zip(image_paths, results))
+
+def list_figure_images(figs_dir):
+    """
+    List the figure and panel images (figure_*.png) in a directory.
+    """
+    return sorted(glob.glob(os.path.join(figs_dir, "figure_*.png")))
+
+def describe_images(image_paths, concurrency=DEFAULT_CONCURRENCY, client=None):
+    """
+    Synchronous entry point for batch mode. `client` is a synchronous
+    Anthropic client whose settings the async requests reuse; its event
+    loop ends with this call, so the async client is closed with it.
+    """
+    async def run():
+        async with async_client(client) as aclient:
+            return await describe_images_async(image_paths, concurrency, aclient)
+    return asyncio.run(run())
 
 def save_description(description, output_path):
     """
@@ -119,7 +188,7 @@ def save_description(description, output_path):
         print(f"\nDescription saved to: {output_path}")
     except Exception as e:
         print(f"Error saving description to file: {e}")
-        sys.exit(1)
+        raise
 
 def get_output_filename(image_path):
     """
@@ -129,22 +198,36 @@ def get_output_filename(image_path):
     return f"{base_path}_blind.txt"
 
 def main():
-    # Check if image path is provided
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <path_to_image>")
-        sys.exit(1)
-    
-    image_path = sys.argv[1]
-    
+    parser = argparse.ArgumentParser(description='Describe scientific figures with Claude')
+    parser.add_argument('path', help='Path to a figure image, or a figures directory for batch mode')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                      help=f'Maximum concurrent requests in batch mode (default: {DEFAULT_CONCURRENCY})')
+
+    args = parser.parse_args()
+
     # Check if file exists
-    if not os.path.exists(image_path):
-        print(f"Error: Image file '{image_path}' does not exist.")
+    if not os.path.exists(args.path):
+        print(f"Error: Image file '{args.path}' does not exist.")
+        sys.exit(1)
+
+    # Batch mode: describe every figure and panel in the directory at once
+    if os.path.isdir(args.path):
+        image_paths = list_figure_images(args.path)
+        print(f"Describing {len(image_paths)} images with up to {args.concurrency} concurrent requests...")
+        results = describe_images(image_paths, args.concurrency)
+        failed = [path for path, result in results.items() if isinstance(result, Exception)]
+        if failed:
+            print(f"Failed to describe {len(failed)} image(s): {', '.join(failed)}")
+            sys.exit(1)
+        return
+
+    # Get and save the description
+    try:
+        description = describe_image(args.path)
+        output_path = get_output_filename(args.path)
+        save_description(description, output_path)
+    except Exception:
         sys.exit(1)
-    
-    # Get and print the description
-    description = describe_image(image_path)
-    output_path = get_output_filename(image_path)
-    save_description(description, output_path)
 
 if __name__ == "__main__":
     main()
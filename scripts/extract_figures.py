@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+import regions
+import image_prep
+
+# bbox values in the metadata are in pixels at the GUI's RENDER_DPI, as
+# gui.py writes them; the crops themselves are rendered at
+# image_prep.crop_dpi, as in the GUI
+CROP_DPI = 150
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+def page_batches(page_count, workers):
+    """Split page numbers into one interleaved batch per worker so long and short pages spread out."""
+    batches = [list(range(start, page_count, workers)) for start in range(workers)]
+    return [batch for batch in batches if batch]
+
+def propose_pages(pdf_path, page_numbers):
+    """Worker: {page_number: [(figure_number, rect, parts), ...]} for a batch of pages."""
+    proposals = {}
+    with fitz.open(pdf_path) as doc:
+        for page_number in page_numbers:
+            proposals[page_number] = [
+                (region.figure_number, tuple(region.rect), [tuple(part) for part in region.parts])
+                for region in regions.propose_regions(doc[page_number])
+            ]
+    return proposals
+
+def render_crops(pdf_path, output_dir, crops):
+    """Worker: render (page_number, rect, filename) crops into output_dir."""
+    with fitz.open(pdf_path) as doc:
+        for page_number, rect, filename in crops:
+            rect = fitz.Rect(rect)
+            pix = doc[page_number].get_pixmap(clip=rect, dpi=image_prep.crop_dpi(rect))
+            pix.save(os.path.join(output_dir, filename))
+    return len(crops)
+
+def reading_order(parts):
+    """Sort panel rects top to bottom in rows, then left to right within a row."""
+    rows = []
+    for part in sorted(parts, key=lambda p: p[1]):
+        for row in rows:
+            # Same row if it overlaps the row's first panel vertically by half its height
+            top, bottom = row[0][1], row[0][3]
+            if min(bottom, part[3]) - max(top, part[1]) > (part[3] - part[1]) / 2:
+                row.append(part)
+                break
+        else:
+            rows.append([part])
+    return [part for row in rows for part in sorted(row, key=lambda p: p[0])]
+
+def plan_figures(proposals, include_uncaptioned=False):
+    """
+    Choose what to save from every page's proposals. Each captioned figure
+    number is used once, at its first occurrence; a region made of several
+    separate graphics becomes a detailed figure with one panel per graphic.
+    Uncaptioned regions are numbered after the captioned ones if included.
+    Returns metadata entries with page and rect (in points) filled in.
+    """
+    figures = {}
+    uncaptioned = []
+    for page_number in sorted(proposals):
+        for figure_number, rect, parts in proposals[page_number]:
+            if figure_number is None:
+                uncaptioned.append((page_number, rect, parts))
+            elif figure_number not in figures:
+                figures[figure_number] = (page_number, rect, parts)
+
+    if include_uncaptioned:
+        next_number = max(figures, default=0) + 1
+        for page_number, rect, parts in uncaptioned:
+            figures[next_number] = (page_number, rect, parts)
+            next_number += 1
+
+    entries = []
+    for figure_number in sorted(figures):
+        page_number, rect, parts = figures[figure_number]
+        if len(parts) > 1:
+            entries.append(("full", figure_number, None, page_number, rect))
+            for panel_number, part in enumerate(reading_order(parts), start=1):
+                entries.append(("panel", figure_number, panel_number, page_number, part))
+        else:
+            entries.append(("single", figure_number, None, page_number, rect))
+    return entries
+
+def figure_filename(fig_type, figure_number, panel_number):
+    """The file name gui.py uses for a figure, full figure or panel."""
+    if fig_type == "single":
+        return f"figure_{figure_number}.png"
+    elif fig_type == "full":
+        return f"figure_{figure_number}_full.png"
+    return f"figure_{figure_number}_panel_{panel_number}.png"
+
+def extract_figures(pdf_path, output_dir, workers=DEFAULT_WORKERS, include_uncaptioned=False):
+    """
+    Detect and save every figure in a PDF without the GUI, writing the same
+    figure images and figures_metadata.json that gui.py's Save Figures does.
+    Pages are analysed and rendered in a pool of worker processes.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    workers = max(1, min(workers, page_count))
+    batches = page_batches(page_count, workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        proposals = {}
+        for batch_proposals in executor.map(propose_pages, [pdf_path] * len(batches), batches):
+            proposals.update(batch_proposals)
+
+        entries = plan_figures(proposals, include_uncaptioned)
+        scale = CROP_DPI / 72
+        metadata = {"figures": []}
+        crops_by_batch = [[] for _ in batches]
+        for fig_type, figure_number, panel_number, page_number, rect in entries:
+            filename = figure_filename(fig_type, figure_number, panel_number)
+            crops_by_batch[page_number % workers].append((page_number, rect, filename))
+            metadata["figures"].append({
+                "filename": filename,
+                "type": fig_type,
+                "figure_number": figure_number,
+                "panel_number": panel_number,
+                "page": page_number + 1,
+                "bbox": [rect[0] * scale, rect[1] * scale, rect[2] * scale, rect[3] * scale]
+            })
+
+        list(executor.map(
+            render_crops,
+            [pdf_path] * len(batches), [output_dir] * len(batches), crops_by_batch
+        ))
+
+    metadata_path = os.path.join(output_dir, "figures_metadata.json")
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    print(f"Saved {len(entries)} figure images from {page_count} pages to {output_dir}")
+    return metadata
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract figures from a PDF without the GUI')
+    parser.add_argument('pdf_path', help='Path to the paper')
+    parser.add_argument('output_dir', help='Directory for the figure images and figures_metadata.json')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                      help=f'Worker processes for analysing and rendering pages (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--include-uncaptioned', action='store_true',
+                      help='Also save graphics with no "Figure N" caption, numbered after the captioned figures')
+
+    args = parser.parse_args()
+    if not os.path.exists(args.pdf_path):
+        print(f"Error: File '{args.pdf_path}' does not exist.")
+        sys.exit(1)
+
+    extract_figures(args.pdf_path, args.output_dir, args.workers, args.include_uncaptioned)
+
+if __name__ == "__main__":
+    main()
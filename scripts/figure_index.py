@@ -0,0 +1,115 @@
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from chunking import CHARS_PER_TOKEN, estimate_tokens, head_context
+
+# Paper text sent with each figure explanation request, about the same
+# size as the first 5000 characters that were sent before
+FIGURE_CONTEXT_TOKENS = 1500
+FALLBACK_CHARS = 5000
+
+# "Fig. 2", "Figure 2b", "Figs. 2 and 3", "Figures 2-4", "Fig. 2a, c"
+MENTION = re.compile(
+    r'\b(Fig(?:ure)?s?\.?)\s*'
+    r'(\d+[a-zA-Z]?(?:\s*(?:,|and|&|to|-|–)\s*\d+[a-zA-Z]?|,\s*[a-zA-Z]\b)*)'
+)
+MENTION_NUMBER = re.compile(r'\d+')
+MENTION_RANGE = re.compile(r'(\d+)[a-zA-Z]?\s*(?:to|-|–)\s*(\d+)')
+
+# Figures of the supplement share numbers with the main figures
+OTHER_FIGURES = re.compile(r'(?:Supplementary|Supplemental|Extended Data|Appendix)\s*$', re.IGNORECASE)
+
+# A paragraph that starts "Figure 2." / "Fig. 2 |" / "Figure 2: ..." is its caption
+CAPTION = re.compile(r'^\s*(?:Figure|Fig\.?)\s*(\d+)\s*(?:[.:|]|\s+[A-Z])')
+
+def split_paragraphs(text):
+    """Paragraphs of text, whitespace normalized."""
+    paragraphs = (re.sub(r'\s+', ' ', p).strip() for p in re.split(r'\n\s*\n', text))
+    return [p for p in paragraphs if p]
+
+def mentioned_figures(paragraph):
+    """Numbers of the main-text figures a paragraph refers to."""
+    numbers = set()
+    for match in MENTION.finditer(paragraph):
+        if OTHER_FIGURES.search(paragraph[:match.start()]):
+            continue
+        for start, end in MENTION_RANGE.findall(match.group(2)):
+            if int(start) < int(end) <= int(start) + 20:
+                numbers.update(range(int(start), int(end) + 1))
+        numbers.update(int(n) for n in MENTION_NUMBER.findall(match.group(2)))
+    return numbers
+
+class FigureIndex:
+    """
+    Inverted index from figure number to the paragraphs of a paper that
+    caption or mention it, so each figure explanation can be given the
+    passages that discuss the figure rather than the start of the paper.
+    """
+
+    def __init__(self, paper_text):
+        self.paragraphs = split_paragraphs(paper_text)
+        self.captions = {}
+        self.mentions = {}
+        for index, paragraph in enumerate(self.paragraphs):
+            caption = CAPTION.match(paragraph)
+            if caption:
+                self.captions.setdefault(int(caption.group(1)), index)
+            for number in mentioned_figures(paragraph):
+                self.mentions.setdefault(number, []).append(index)
+
+    def passages(self, figure_number, max_tokens=FIGURE_CONTEXT_TOKENS):
+        """
+        The caption followed by the paragraphs mentioning the figure, in
+        document order, up to max_tokens. Paragraphs that do not fit are
+        skipped in favour of later, shorter ones.
+        """
+        selected = []
+        used = 0
+        caption = self.captions.get(figure_number)
+        if caption is not None:
+            # Long captions are cut to whole sentences within the budget
+            text = head_context(self.paragraphs[caption], max_tokens)
+            text = text or self.paragraphs[caption][:int(max_tokens * CHARS_PER_TOKEN)]
+            selected.append(text)
+            used += estimate_tokens(text)
+
+        for index in self.mentions.get(figure_number, []):
+            if index == caption:
+                continue
+            tokens = estimate_tokens(self.paragraphs[index])
+            if used + tokens <= max_tokens:
+                selected.append(self.paragraphs[index])
+                used += tokens
+        return selected
+
+# Indexes kept in memory, most recently used last; one per paper in flight
+# is all that is reused, so a long --watch run doesn't keep every paper's
+MAX_INDEXES = 8
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+def get_index(paper_text):
+    """The FigureIndex for a paper, built once per distinct text."""
+    key = hashlib.sha256(paper_text.encode('utf-8')).hexdigest()
+    with _lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+        else:
+            _indexes[key] = FigureIndex(paper_text)
+            while len(_indexes) > MAX_INDEXES:
+                _indexes.popitem(last=False)
+        return _indexes[key]
+
+def figure_context(paper_text, figure_number, max_tokens=FIGURE_CONTEXT_TOKENS):
+    """
+    Paper text to send with an explanation of figure_number: its caption
+    and the passages discussing it, or the start of the paper when the
+    figure is never mentioned.
+    """
+    passages = get_index(paper_text).passages(figure_number, max_tokens)
+    if not passages:
+        return paper_text[:FALLBACK_CHARS]
+    return "\n\n".join(passages)
@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import anthropic
+
+import describe
+import context
+from llm_cache import create_message, create_text
+from image_prep import image_prep_stats
+from manifest import hash_inputs
+
+def figure_sort_key(path):
+    """Sort figure files by figure number, then panel number."""
+    name = os.path.basename(path)
+    numbers = [int(n) for n in re.findall(r'\d+', name)]
+    return numbers, name
+
+def describe_inputs_hash(image_path):
+    """Everything that determines a figure description."""
+    with open(image_path, 'rb') as f:
+        return hash_inputs(f.read(), describe.DESCRIBE_PROMPT)
+
+def describe_figures(figs_dir, concurrency=describe.DEFAULT_CONCURRENCY, manifest=None, client=None):
+    """
+    Describe every figure and panel image in figs_dir concurrently,
+    writing each *_blind.txt as its response arrives. Images already
+    described from the same inputs are skipped when a manifest is given.
+    The requests use the API key and base URL of `client`, if given.
+    """
+    image_paths = describe.list_figure_images(figs_dir)
+    input_hashes = {path: describe_inputs_hash(path) for path in image_paths}
+    if manifest is not None:
+        image_paths = [
+            path for path in image_paths
+            if not manifest.is_done(f"describe:{os.path.basename(path)}", input_hashes[path])
+        ]
+
+    print(f"Describing {len(image_paths)} images with up to {concurrency} concurrent requests...")
+    results = describe.describe_images(image_paths, concurrency, client=client)
+    for image_path, result in results.items():
+        if isinstance(result, Exception):
+            print(f"Skipping {image_path}: {result}")
+        elif manifest is not None:
+            manifest.mark_done(f"describe:{os.path.basename(image_path)}", input_hashes[image_path], [result])
+
+def panel_narrative(figure_number, explanations):
+    """Join a detailed figure's panel explanations into one flowing narrative."""
+    narrative = [f"Figure {figure_number} shows a series of experiments examining "]
+    for explanation in explanations:
+        # Remove any "Figure X." prefix if present
+        narrative.append(re.sub(r'^Figure \d+\.', '', explanation, flags=re.MULTILINE))
+    return "\n\n".join(narrative)
+
+def contextualize_detailed_figure(paper_text, figs_dir, figure_number, client=None, manifest=None):
+    """
+    Explain each panel of a detailed figure in context and join them into
+    a single flowing figure_N_blind_contextual.txt.
+    """
+    full_desc_path = os.path.join(figs_dir, f"figure_{figure_number}_full_blind.txt")
+    full_figure_desc = context.read_description(full_desc_path)
+    output_path = os.path.join(figs_dir, f"figure_{figure_number}_blind_contextual.txt")
+
+    panel_descs = sorted(
+        glob.glob(os.path.join(figs_dir, f"figure_{figure_number}_panel_*_blind.txt")),
+        key=figure_sort_key
+    )
+    panel_texts = [context.read_description(panel_desc) for panel_desc in panel_descs]
+
+    figure_unit = f"context:figure_{figure_number}"
+    figure_hash = hash_inputs(paper_text, full_figure_desc, *panel_texts)
+    if manifest is not None and manifest.is_done(figure_unit, figure_hash):
+        print(f"Figure {figure_number} already explained, skipping")
+        return
+
+    explanations = []
+    complete = True
+    for panel_desc, panel_text in zip(panel_descs, panel_texts):
+        panel_unit = f"context:{os.path.basename(panel_desc)}"
+        panel_hash = hash_inputs(paper_text, full_figure_desc, panel_text)
+        explanation = manifest.get_result(panel_unit, panel_hash) if manifest is not None else None
+
+        if explanation is None:
+            print(f"Processing detailed figure {figure_number} with panel: {panel_desc}")
+            try:
+                explanation = context.get_contextual_explanation(
+                    paper_text, panel_text, figure_number, full_figure_desc, client=client
+                )
+            except Exception as e:
+                print(f"Skipping {panel_desc}: {e}")
+                complete = False
+                continue
+            if manifest is not None:
+                manifest.mark_done(panel_unit, panel_hash, result=explanation)
+
+        explanations.append(explanation)
+
+    context.save_explanation(panel_narrative(figure_number, explanations), output_path)
+    if manifest is not None and complete:
+        manifest.mark_done(figure_unit, figure_hash, [output_path])
+
+def contextualize_figures(paper_text, figs_dir, client=None, manifest=None):
+    """
+    Turn every *_blind.txt description into a listener-facing
+    *_blind_contextual.txt explanation.
+    """
+    descriptions = sorted(glob.glob(os.path.join(figs_dir, "figure_*_blind.txt")), key=figure_sort_key)
+    for desc_path in descriptions:
+        name = os.path.basename(desc_path)
+        if name.endswith("_full_blind.txt"):
+            figure_number = context.extract_figure_number(name)
+            contextualize_detailed_figure(paper_text, figs_dir, figure_number, client=client, manifest=manifest)
+        elif "_panel_" not in name and "_full_" not in name:
+            figure_number = context.extract_figure_number(name)
+            figure_desc = context.read_description(desc_path)
+            output_path = os.path.splitext(desc_path)[0] + "_contextual.txt"
+
+            unit = f"context:figure_{figure_number}"
+            input_hash = hash_inputs(paper_text, figure_desc)
+            if manifest is not None and manifest.is_done(unit, input_hash):
+                print(f"Figure {figure_number} already explained, skipping")
+                continue
+
+            print(f"Processing regular figure: {desc_path}")
+            try:
+                explanation = context.get_contextual_explanation(
+                    paper_text, figure_desc, figure_number, client=client
+                )
+                context.save_explanation(explanation, output_path)
+            except Exception as e:
+                print(f"Skipping {desc_path}: {e}")
+                continue
+            if manifest is not None:
+                manifest.mark_done(unit, input_hash, [output_path])
+
+def context_requests(paper_text, figs_dir):
+    """
+    The explanation requests contextualize_figures would send for figs_dir,
+    for batch submission. Descriptions must already be written.
+    """
+    requests = []
+    descriptions = sorted(glob.glob(os.path.join(figs_dir, "figure_*_blind.txt")), key=figure_sort_key)
+    for desc_path in descriptions:
+        name = os.path.basename(desc_path)
+        if name.endswith("_full_blind.txt"):
+            figure_number = context.extract_figure_number(name)
+            full_figure_desc = context.read_description(desc_path)
+            panel_descs = glob.glob(os.path.join(figs_dir, f"figure_{figure_number}_panel_*_blind.txt"))
+            for panel_desc in sorted(panel_descs, key=figure_sort_key):
+                requests.append(context.build_request(
+                    paper_text, context.read_description(panel_desc), figure_number, full_figure_desc
+                ))
+        elif "_panel_" not in name and "_full_" not in name:
+            figure_number = context.extract_figure_number(name)
+            requests.append(context.build_request(paper_text, context.read_description(desc_path), figure_number))
+    return requests
+
+# Each panel's explanation in a detailed figure response starts "Panel N:"
+PANEL_MARKER = re.compile(r'^[ \t*#]*Panel (\d+)[*]*:[*]*[ \t]*', re.MULTILINE)
+
+def panel_number(image_path):
+    """Panel number of a figure_N_panel_M.png image."""
+    return int(re.search(r'_panel_(\d+)', os.path.basename(image_path)).group(1))
+
+def split_panel_explanations(text):
+    """{panel_number: explanation} from a detailed figure response, in response order."""
+    parts = PANEL_MARKER.split(text)
+    return {int(parts[i]): parts[i + 1].strip() for i in range(1, len(parts) - 1, 2)}
+
+def fused_jobs(figs_dir):
+    """
+    (figure_number, image_path, panel_paths) for every figure in figs_dir,
+    in figure order. For a regular figure image_path is its image and
+    panel_paths is None; for a detailed figure image_path is the full
+    figure image and panel_paths its panel images.
+    """
+    jobs = []
+    for image_path in sorted(describe.list_figure_images(figs_dir), key=figure_sort_key):
+        name = os.path.basename(image_path)
+        match = re.match(r'figure_(\d+)', name)
+        if not match or "_panel_" in name:
+            continue
+        figure_number = int(match.group(1))
+        if name.endswith("_full.png"):
+            panel_paths = sorted(
+                glob.glob(os.path.join(figs_dir, f"figure_{figure_number}_panel_*.png")),
+                key=figure_sort_key
+            )
+            jobs.append((figure_number, image_path, panel_paths))
+        else:
+            jobs.append((figure_number, image_path, None))
+    return jobs
+
+def fused_request(paper_text, figure_number, image_path, panel_paths):
+    """The first (usually only) request for a fused_jobs entry."""
+    if panel_paths is None:
+        return context.build_fused_request(paper_text, image_path, figure_number)
+    panels = [(panel_number(path), path) for path in panel_paths]
+    return context.build_detailed_request(paper_text, figure_number, image_path, panels)
+
+def fused_requests(paper_text, figs_dir):
+    """The requests explain_figures would send for figs_dir, for batch submission."""
+    return [fused_request(paper_text, *job) for job in fused_jobs(figs_dir)]
+
+def explain_detailed_figure(paper_text, figure_number, full_image_path, panel_paths, client):
+    """
+    Explain every panel of a detailed figure in one request carrying the
+    full figure and all panel images. If the response runs out of tokens,
+    the panel it was cut off in and any after it are asked for again in a
+    follow-up request; if not even one panel fit, the next panel is asked
+    for on its own. Returns the explanations in panel order.
+    """
+    remaining = [(panel_number(path), path) for path in panel_paths]
+    explanations = {}
+    batch = remaining
+    while remaining:
+        request = context.build_detailed_request(paper_text, figure_number, full_image_path, batch)
+        response = create_message(client, request)
+        parsed = split_panel_explanations(response["text"])
+        truncated = response.get("stop_reason") == "max_tokens"
+        if truncated and parsed:
+            # The last panel in the response was cut off
+            parsed.pop(list(parsed)[-1])
+        elif len(batch) == 1 and not parsed and not truncated and response["text"].strip():
+            # Asked for one panel, the answer may not be headed "Panel N:"
+            parsed = {batch[0][0]: response["text"].strip()}
+
+        wanted = {number for number, _ in batch}
+        found = {number: text for number, text in parsed.items() if number in wanted and text}
+        if not found:
+            if truncated and len(batch) > 1:
+                print(f"Figure {figure_number}: panel {batch[0][0]} filled the whole response, "
+                      "requesting it on its own")
+                batch = batch[:1]
+                continue
+            raise RuntimeError(f"No panel explanations found in the response for figure {figure_number}")
+        explanations.update(found)
+        remaining = [(number, path) for number, path in remaining if number not in explanations]
+        batch = remaining
+        if remaining:
+            print(f"Figure {figure_number}: requesting {len(remaining)} remaining panels")
+
+    return [explanations[panel_number(path)] for path in panel_paths]
+
+def explain_figures(paper_text, figs_dir, concurrency=describe.DEFAULT_CONCURRENCY, client=None, manifest=None):
+    """
+    Fused alternative to describe_figures + contextualize_figures: each
+    figure's images go to Claude with the paper passages about it and the
+    listener-facing explanation comes back directly. A regular figure is
+    one request; a detailed figure is one request with the full image and
+    every panel (two if the response runs long). Writes the same
+    *_blind_contextual.txt files, but no *_blind.txt descriptions. Every
+    figure is independent, so all of them run concurrently.
+    """
+    if client is None:
+        client = anthropic.Anthropic()
+
+    def explain(figure_number, image_path, panel_paths):
+        request = fused_request(paper_text, figure_number, image_path, panel_paths)
+        unit = f"explain:{os.path.basename(image_path)}"
+        input_hash = hash_inputs(json.dumps(request, sort_keys=True))
+        output_path = os.path.join(figs_dir, f"figure_{figure_number}_blind_contextual.txt")
+        if manifest is not None and manifest.is_done(unit, input_hash):
+            print(f"Figure {figure_number} already explained, skipping")
+            return
+
+        print(f"Explaining {image_path}" + (f" with {len(panel_paths)} panels" if panel_paths else ""))
+        if panel_paths is None:
+            explanation = create_text(client, request)
+        else:
+            explanation = panel_narrative(
+                figure_number, explain_detailed_figure(paper_text, figure_number, image_path, panel_paths, client)
+            )
+        context.save_explanation(explanation, output_path)
+        if manifest is not None:
+            manifest.mark_done(unit, input_hash, [output_path])
+
+    jobs = fused_jobs(figs_dir)
+    print(f"Explaining {len(jobs)} figures with up to {concurrency} concurrent requests...")
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [(job, executor.submit(explain, *job)) for job in jobs]
+    for (_, image_path, _), future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Skipping {image_path}: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Write *_blind_contextual.txt explanations for a paper\'s figures')
+    parser.add_argument('pdf_path', help='Path to the paper; figures are read from its directory')
+    parser.add_argument('--fused', action='store_true',
+                      help='Explain each image in one request instead of describing it first')
+    parser.add_argument('--concurrency', type=int, default=describe.DEFAULT_CONCURRENCY,
+                      help=f'Maximum concurrent requests (default: {describe.DEFAULT_CONCURRENCY})')
+
+    args = parser.parse_args()
+    if not os.path.exists(args.pdf_path):
+        print(f"Error: PDF file '{args.pdf_path}' does not exist.")
+        sys.exit(1)
+
+    figs_dir = os.path.dirname(os.path.abspath(args.pdf_path))
+    paper_text = context.read_pdf(args.pdf_path)
+    if args.fused:
+        explain_figures(paper_text, figs_dir, concurrency=args.concurrency)
+    else:
+        describe_figures(figs_dir, concurrency=args.concurrency)
+        contextualize_figures(paper_text, figs_dir)
+    print(image_prep_stats.summary())
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,97 @@
 import os
 import sys
 import anthropic
-import PyPDF2
+import fitz  # PyMuPDF
 import re
+from llm_cache import create_text
 
 def sanitize_filename(filename):
     """Sanitize a string to make it safe for filenames."""
     # Replace invalid characters with an underscore or remove them
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
-def read_pdf(pdf_path):
-    """Extract text from PDF file."""
-    try:
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading PDF: {e}")
-        sys.exit(1)
+# Metadata titles that are really authoring-tool or file names
+PLACEHOLDER_TITLE = re.compile(
+    r'^(untitled|microsoft word|title|document\d*|paper|manuscript)\b|\.(pdf|docx?|tex|dvi|indd)$',
+    re.IGNORECASE
+)
+
+# The title's font must be this much larger than the page's body text
+TITLE_SIZE_RATIO = 1.3
+
+def normalize_whitespace(text):
+    """Collapse runs of whitespace into single spaces."""
+    return re.sub(r'\s+', ' ', text).strip()
+
+def looks_like_title(text):
+    """Cheap plausibility check for a candidate title."""
+    words = text.split()
+    if len(words) < 3 or len(text) > 300:
+        return False
+    if PLACEHOLDER_TITLE.search(text):
+        return False
+    # Mostly letters, not a DOI, date line or journal header full of digits
+    letters = sum(c.isalpha() for c in text)
+    return letters >= 0.6 * len(text.replace(" ", ""))
+
+def title_from_metadata(doc, first_page_text):
+    """
+    Use the /Title metadata field, but only when it is plausible and
+    actually appears on page 1, since many PDFs carry stale or tool-generated titles.
+    """
+    title = normalize_whitespace((doc.metadata or {}).get("title") or "")
+    if not looks_like_title(title):
+        return None
+    if title.lower() not in normalize_whitespace(first_page_text).lower():
+        return None
+    return title
+
+def title_from_font_size(page):
+    """
+    Pick the largest text on page 1. Consecutive lines set in the largest
+    font form the title. The result is trusted only if that font clearly
+    stands out from the body text.
+    """
+    lines = []
+    for block in page.get_text("dict")["blocks"]:
+        for line in block.get("lines", []):
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            if spans:
+                lines.append((
+                    line["bbox"][1],
+                    max(span["size"] for span in spans),
+                    "".join(span["text"] for span in spans)
+                ))
+    if not lines:
+        return None
+
+    # Body text size is the size most characters are set in
+    chars_by_size = {}
+    for _, size, text in lines:
+        chars_by_size[round(size)] = chars_by_size.get(round(size), 0) + len(text)
+    body_size = max(chars_by_size, key=chars_by_size.get)
 
-def get_paper_name(paper_text):
+    title_size = max(size for _, size, _ in lines)
+    if title_size < body_size * TITLE_SIZE_RATIO:
+        return None
+
+    title_lines = []
+    last_top = None
+    for top, size, text in sorted(lines):
+        if abs(size - title_size) > 0.5:
+            continue
+        if last_top is not None and top - last_top > title_size * 2:
+            break
+        title_lines.append(text)
+        last_top = top
+
+    title = normalize_whitespace(" ".join(title_lines))
+    return title if looks_like_title(title) else None
+
+def get_paper_name(paper_text, client=None):
     """Get paper name prediction from Claude."""
-    client = anthropic.Anthropic()
+    if client is None:
+        client = anthropic.Anthropic()
     
     prompt = """You are helping to extract the exact title of a scientific paper. 
     Here are the first 1000 characters of the paper. The title is typically found at the beginning.
@@ -41,22 +108,38 @@ def get_paper_name(paper_text):
     """
     
     try:
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=500,
-            messages=[
+        return create_text(client, {
+            "model": "claude-3-5-sonnet-20241022",
+            "max_tokens": 500,
+            "messages": [
                 {
                     "role": "user", 
                     "content": prompt.format(paper_text=paper_text[:1000])
                 }
             ]
-        )
-        return message.content[0].text
+        })
     except Exception as e:
         print(f"Error getting paper name from Claude: {e}")
         if hasattr(e, 'response') and hasattr(e.response, 'text'):
             print(f"Detailed error: {e.response.text}")
-        sys.exit(1)
+        raise
+
+def predict_title(pdf_path, client=None):
+    """
+    Find the paper title from page 1 alone: the /Title metadata field,
+    then the largest font on the page, and only if neither is confident,
+    a Claude call on the first 1000 characters of page 1.
+    """
+    with fitz.open(pdf_path) as doc:
+        # Loading a single page does not parse the rest of the document
+        first_page = doc[0]
+        first_page_text = first_page.get_text("text")
+
+        title = title_from_metadata(doc, first_page_text) or title_from_font_size(first_page)
+
+    if title:
+        return title
+    return get_paper_name(first_page_text[:1000], client=client)
 
 def main():
     if len(sys.argv) != 2:
@@ -70,12 +153,11 @@ def main():
         print(f"Error: PDF file '{pdf_path}' does not exist.")
         sys.exit(1)
 
-    # Read PDF and get first 1000 chars
-    paper_text = read_pdf(pdf_path)
-    truncated_text = paper_text[:1000]
-
-    # Get predicted paper name
-    paper_name = get_paper_name(truncated_text)
+    try:
+        paper_name = predict_title(pdf_path)
+    except Exception as e:
+        print(f"Error predicting paper name: {e}")
+        sys.exit(1)
 
     # Sanitize the paper name for safe usage as a filename
     safe_paper_name = sanitize_filename(paper_name)
@@ -2,13 +2,129 @@ import sys
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton,
     QGraphicsView, QGraphicsScene, QListWidget, QWidget, QSplitter, QFileDialog,
-    QCheckBox
+    QCheckBox, QMessageBox
 )
-from PyQt5.QtGui import QPixmap, QPen
+from PyQt5.QtGui import QPixmap, QPen, QImage, QColor
 from PyQt5.QtCore import Qt, QRectF
 import fitz  # PyMuPDF
 import os
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import regions
+import image_prep
+
+# Resolution pages are shown at; box coordinates are in these pixels
+RENDER_DPI = 150
+
+# Rendered pages kept in memory (about 6 MB each for a letter page at 150 dpi),
+# and how many pages around the current one are rendered ahead of time
+PAGE_CACHE_SIZE = 12
+PREFETCH_AHEAD = 2
+PREFETCH_BEHIND = 1
+
+# A press and release closer than this (in pixels) is a click, not a drag
+CLICK_DISTANCE = 4
+
+def render_page(document, page_number, dpi=RENDER_DPI):
+    """Render a page straight from the pixmap samples into a QImage, with no file in between."""
+    pix = document[page_number].get_pixmap(dpi=dpi, alpha=False)
+    image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
+    # Detach from the samples buffer, which is freed with the pixmap
+    return image.copy()
+
+class PageCache:
+    """
+    Bounded LRU cache of rendered pages with background prefetch.
+
+    Pages near the current one are rendered on a worker thread that has its
+    own fitz Document, as PyMuPDF documents must not be shared between
+    threads. Only QImages cross threads; QPixmaps are made on the GUI thread.
+    The worker also finds each page's proposed figure regions, which are
+    small and kept for every page seen.
+    """
+
+    def __init__(self, pdf_path, document, max_pages=PAGE_CACHE_SIZE):
+        self.pdf_path = pdf_path
+        self.document = document
+        self.max_pages = max_pages
+        self.images = OrderedDict()
+        self.proposals = {}
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._worker_document = None
+
+    def _store(self, page_number, image):
+        with self._lock:
+            self.images[page_number] = image
+            self.images.move_to_end(page_number)
+            while len(self.images) > self.max_pages:
+                self.images.popitem(last=False)
+
+    def _render_in_worker(self, page_number):
+        try:
+            if self._worker_document is None:
+                self._worker_document = fitz.open(self.pdf_path)
+            image = render_page(self._worker_document, page_number)
+            self._store(page_number, image)
+            page_proposals = regions.propose_regions(self._worker_document[page_number])
+            with self._lock:
+                self.proposals.setdefault(page_number, page_proposals)
+            return image
+        finally:
+            with self._lock:
+                self.pending.pop(page_number, None)
+
+    def get(self, page_number):
+        """The rendered page, from the cache, a prefetch in flight, or rendered now."""
+        with self._lock:
+            image = self.images.get(page_number)
+            if image is not None:
+                self.images.move_to_end(page_number)
+                return image
+            future = self.pending.get(page_number)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Prefetch of page {page_number + 1} failed, rendering it now: {e}")
+        image = render_page(self.document, page_number)
+        self._store(page_number, image)
+        return image
+
+    def page_regions(self, page_number):
+        """The page's proposed figure regions, found now only if no prefetch did."""
+        with self._lock:
+            found = self.proposals.get(page_number)
+            future = self.pending.get(page_number)
+        if found is None and future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass  # Found below instead
+            with self._lock:
+                found = self.proposals.get(page_number)
+        if found is None:
+            found = regions.propose_regions(self.document[page_number])
+            with self._lock:
+                self.proposals[page_number] = found
+        return found
+
+    def prefetch(self, page_number):
+        """Queue rendering of the pages around page_number that are not cached yet."""
+        nearby = [page_number + offset for offset in range(1, PREFETCH_AHEAD + 1)]
+        nearby += [page_number - offset for offset in range(1, PREFETCH_BEHIND + 1)]
+        with self._lock:
+            for number in nearby:
+                cached = number in self.images and number in self.proposals
+                if 0 <= number < len(self.document) and not cached and number not in self.pending:
+                    self.pending[number] = self._executor.submit(self._render_in_worker, number)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
 class PDFViewer(QMainWindow):
     def __init__(self, pdf_path):
@@ -94,15 +210,21 @@ class PDFViewer(QMainWindow):
 
         # PDF Variables
         self.pdf_document = None
+        self.page_cache = None
         self.current_page = 0
         self.current_pixmap = None
         self.start_pos = None
+        self.press_pos = None
         self.end_pos = None
         self.selection_box = None
         self.figure_boxes = []  # Store boxes as tuples (page, QRectF, type, parent_id)
         self.current_figure_id = 0  # To track the parent figure for panels
         self.detailed_mode = False
 
+        # Proposed figure regions on the current page, and the one behind the current selection
+        self.proposal_boxes = []  # (scene rect, figure_number, is_part) for the current page
+        self.selected_proposal = None
+
         self.graphics_view.mousePressEvent = self.start_box
         self.graphics_view.mouseMoveEvent = self.update_box
         self.graphics_view.mouseReleaseEvent = self.finish_box
@@ -133,6 +255,7 @@ class PDFViewer(QMainWindow):
     def load_pdf(self, file_path):
         if file_path and os.path.exists(file_path):
             self.pdf_document = fitz.open(file_path)
+            self.page_cache = PageCache(file_path, self.pdf_document)
             self.current_page = 0
             self.show_page()
             self.save_button.setEnabled(True)
@@ -143,24 +266,93 @@ class PDFViewer(QMainWindow):
 
     def show_page(self):
         if self.pdf_document:
-            page = self.pdf_document[self.current_page]
-            pix = page.get_pixmap(dpi=150)
-            img_path = "temp_page.png"
-            pix.save(img_path)
-
-            pixmap = QPixmap(img_path)
+            pixmap = QPixmap.fromImage(self.page_cache.get(self.current_page))
             self.current_pixmap = pixmap
             self.scene.clear()
             self.scene.addPixmap(pixmap)
             self.selection_box = None
+            self.selected_proposal = None
+            self.page_cache.prefetch(self.current_page)
+            self.show_proposals()
+
+    def show_proposals(self):
+        """
+        Outline the figure regions found on this page. Clicking one selects
+        it with the paper's own figure number; in detailed mode the
+        separate graphics inside a figure can be clicked as panels.
+        """
+        scale = RENDER_DPI / 72
+        figure_pen = QPen(QColor(0, 120, 215))
+        figure_pen.setWidth(2)
+        figure_pen.setStyle(Qt.DashLine)
+        panel_pen = QPen(QColor(0, 120, 215))
+        panel_pen.setStyle(Qt.DotLine)
+
+        self.proposal_boxes = []
+        for region in self.page_cache.page_regions(self.current_page):
+            rect = QRectF(region.rect.x0 * scale, region.rect.y0 * scale,
+                          region.rect.width * scale, region.rect.height * scale)
+            self.scene.addRect(rect, figure_pen)
+            label = self.scene.addSimpleText(
+                f"Figure {region.figure_number}" if region.figure_number else "Figure ?"
+            )
+            label.setBrush(QColor(0, 120, 215))
+            label.setPos(rect.left(), max(0, rect.top() - 16))
+            self.proposal_boxes.append((rect, region.figure_number, False))
+
+            if len(region.parts) > 1:
+                for part in region.parts:
+                    part_rect = QRectF(part.x0 * scale, part.y0 * scale, part.width * scale, part.height * scale)
+                    self.scene.addRect(part_rect, panel_pen)
+                    self.proposal_boxes.append((part_rect, region.figure_number, True))
+
+    def select_proposal(self, pos):
+        """Select the smallest proposed region under pos. Returns True if there was one."""
+        hits = [box for box in self.proposal_boxes if box[0].contains(pos)]
+        if not hits:
+            return False
+        rect, figure_number, is_part = min(hits, key=lambda hit: hit[0].width() * hit[0].height())
+        # A part carries its figure's number, which is only right for a
+        # panel; added on its own it is a new figure
+        if is_part and not self.detailed_mode:
+            figure_number = None
+
+        if self.selection_box:
+            self.scene.removeItem(self.selection_box)
+        pen = QPen(Qt.red)
+        pen.setWidth(2)
+        self.selection_box = self.scene.addRect(rect, pen)
+        self.selected_proposal = figure_number
+        return True
+
+    def proposed_figure_number(self):
+        """
+        The paper's number for the selected figure, or the next free number.
+        If that figure was already added, asks whether to add the selection
+        under the next free number instead; returns None if not.
+        """
+        if self.selected_proposal is None:
+            return self.next_figure_number
+        added = {number for _, _, kind, number, _ in self.figure_boxes if kind in ("single", "full")}
+        if self.selected_proposal not in added:
+            return self.selected_proposal
+        answer = QMessageBox.question(
+            self, "Figure already added",
+            f"Figure {self.selected_proposal} has already been added. "
+            f"Add this selection as Figure {self.next_figure_number}?"
+        )
+        return self.next_figure_number if answer == QMessageBox.Yes else None
 
     def start_box(self, event):
         if event.button() == Qt.LeftButton:
             self.start_pos = self.graphics_view.mapToScene(event.pos())
+            self.press_pos = event.pos()
+            self.end_pos = None
 
     def update_box(self, event):
         if self.start_pos:
             self.end_pos = self.graphics_view.mapToScene(event.pos())
+            self.selected_proposal = None
             if self.selection_box:
                 self.scene.removeItem(self.selection_box)
             rect = QRectF(self.start_pos, self.end_pos).normalized()
@@ -169,6 +361,16 @@ class PDFViewer(QMainWindow):
             self.selection_box = self.scene.addRect(rect, pen)
 
     def finish_box(self, event):
+        if (event.button() == Qt.LeftButton and self.start_pos
+                and (event.pos() - self.press_pos).manhattanLength() < CLICK_DISTANCE):
+            # A click on a proposed region selects it, like a dragged box
+            if self.select_proposal(self.start_pos):
+                if self.detailed_mode:
+                    self.add_full_figure_button.setEnabled(True)
+                    self.add_panel_button.setEnabled(True)
+                else:
+                    self.add_figure_button.setEnabled(True)
+            return
         if event.button() == Qt.LeftButton and self.start_pos and self.end_pos:
             self.end_pos = self.graphics_view.mapToScene(event.pos())
             if self.detailed_mode:
@@ -180,16 +382,21 @@ class PDFViewer(QMainWindow):
     def add_figure(self):
         if self.selection_box:
             rect = self.selection_box.rect()
-            figure_number = self.next_figure_number
+            figure_number = self.proposed_figure_number()
+            if figure_number is None:
+                return
             self.figure_boxes.append((self.current_page, rect, "single", figure_number, None))
             self.figure_list.addItem(f"Figure {figure_number}")
             self.add_figure_button.setEnabled(False)
-            self.next_figure_number += 1
+            self.next_figure_number = max(self.next_figure_number, figure_number + 1)
 
     def add_full_figure(self):
         if self.selection_box:
             rect = self.selection_box.rect()
-            self.current_detailed_figure = self.next_figure_number
+            figure_number = self.proposed_figure_number()
+            if figure_number is None:
+                return
+            self.current_detailed_figure = figure_number
             self.panel_count = 0
             self.figure_boxes.append((
                 self.current_page, 
@@ -232,7 +439,7 @@ class PDFViewer(QMainWindow):
             # If we're switching out of detailed mode, make sure to increment the figure number
             # past the last detailed figure we were working on
             if self.current_detailed_figure is not None:
-                self.next_figure_number = self.current_detailed_figure + 1
+                self.next_figure_number = max(self.next_figure_number, self.current_detailed_figure + 1)
                 self.current_detailed_figure = None
             self.add_figure_button.show()
             self.add_full_figure_button.hide()
@@ -283,8 +490,9 @@ class PDFViewer(QMainWindow):
             else:  # panel
                 filename = f"figure_{figure_number}_panel_{panel_number}.png"
 
-            # Save the image
-            pix = page.get_pixmap(clip=fitz_rect, dpi=150)
+            # Save the image, at the resolution that fills the vision
+            # model's pixel budget for a crop of this size
+            pix = page.get_pixmap(clip=fitz_rect, dpi=image_prep.crop_dpi(fitz_rect))
             img_path = os.path.join(output_folder, filename)
             pix.save(img_path)
 
@@ -322,6 +530,11 @@ class PDFViewer(QMainWindow):
             self.current_page -= 1
             self.show_page()
 
+    def closeEvent(self, event):
+        if self.page_cache:
+            self.page_cache.close()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -0,0 +1,117 @@
+import io
+import os
+import math
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+# Claude downsamples any image whose long edge is over 1568 px or whose
+# area is over about 1.15 megapixels, and bills roughly one token per
+# 750 pixels. Images inside both limits are used as sent.
+MAX_LONG_EDGE = 1568
+MAX_PIXELS = 1_150_000
+PIXELS_PER_TOKEN = 750
+
+# Crops are rendered at whatever resolution fills the budget, within
+# these bounds: small panels get more detail, large figures are not
+# rendered bigger than Claude will look at
+MIN_CROP_DPI = 72
+MAX_CROP_DPI = 600
+
+def estimate_image_tokens(width, height):
+    """Approximate input tokens Claude bills for an image of this size."""
+    return math.ceil(width * height / PIXELS_PER_TOKEN)
+
+def fit_scale(width, height):
+    """Scale factor that brings width x height to the pixel budget (may be above 1)."""
+    return min(MAX_LONG_EDGE / max(width, height), math.sqrt(MAX_PIXELS / (width * height)))
+
+def crop_dpi(rect):
+    """
+    Resolution to render a crop of a page at, given its rect in PDF points
+    (72 per inch), so the image lands on the pixel budget.
+    """
+    if rect.width <= 0 or rect.height <= 0:
+        return MIN_CROP_DPI
+    dpi = 72 * fit_scale(rect.width, rect.height)
+    return int(max(MIN_CROP_DPI, min(MAX_CROP_DPI, dpi)))
+
+class ImagePrepStats:
+    """Bytes and estimated image tokens before and after preparation, for this process."""
+
+    def __init__(self):
+        self.images = 0
+        self.original_bytes = 0
+        self.prepared_bytes = 0
+        self.original_tokens = 0
+        self.prepared_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, original_bytes, prepared_bytes, original_size, prepared_size):
+        with self._lock:
+            self.images += 1
+            self.original_bytes += original_bytes
+            self.prepared_bytes += prepared_bytes
+            self.original_tokens += estimate_image_tokens(*original_size)
+            self.prepared_tokens += estimate_image_tokens(*prepared_size)
+
+    def summary(self):
+        """Summary line for logs."""
+        with self._lock:
+            return (f"Images: {self.images} prepared, {self.prepared_bytes / 1024:.0f} KB uploaded instead of "
+                    f"{self.original_bytes / 1024:.0f} KB, ~{self.prepared_tokens} image tokens instead of "
+                    f"~{self.original_tokens}")
+
+image_prep_stats = ImagePrepStats()
+
+# Prepared images kept in memory, most recently used last. A figure's
+# image is sent by the describe and context stages of the same paper, so
+# a few papers' worth is enough; older ones are prepared again if needed
+MAX_PREPARED = 64
+
+_prepared = OrderedDict()
+_lock = threading.Lock()
+
+def _encode(image, fmt, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+def prepare_image(image_path):
+    """
+    Image bytes to upload for a figure: downsampled to the pixel budget if
+    it is over it (Claude would do so anyway, after the upload), then
+    re-encoded as the smaller of optimized PNG and lossless WebP. Lossy
+    formats are avoided because they blur axis labels and small text.
+    Returns (media_type, data). The file on disk is left as it is.
+    """
+    stat = os.stat(image_path)
+    key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if key in _prepared:
+            _prepared.move_to_end(key)
+            return _prepared[key]
+
+    with Image.open(image_path) as original:
+        original_size = original.size
+        image = original.convert("RGBA" if "A" in original.getbands() else "RGB")
+
+    scale = fit_scale(*image.size)
+    if scale < 1:
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+
+    candidates = [("image/png", _encode(image, "PNG", optimize=True))]
+    try:
+        candidates.append(("image/webp", _encode(image, "WEBP", lossless=True, method=6)))
+    except (OSError, KeyError):
+        pass  # Pillow built without WebP
+    media_type, data = min(candidates, key=lambda candidate: len(candidate[1]))
+
+    image_prep_stats.record(stat.st_size, len(data), original_size, image.size)
+    with _lock:
+        _prepared[key] = (media_type, data)
+        while len(_prepared) > MAX_PREPARED:
+            _prepared.popitem(last=False)
+    return media_type, data
@@ -121,6 +121,42 @@ def intersperse_figures_with_text(text, figures_dir):
     
     return '\n'.join(result)
 
+def intersperse_stream(chunks, figure_descriptions, total_length):
+    """
+    Streaming counterpart of intersperse_figures_with_text.
+
+    Cleaned text arrives one chunk at a time, so the final length is not
+    known yet. Figures are placed by how much of the source text has been
+    consumed instead: figure i goes after the first chunk that brings the
+    consumed share to i / (num_figures + 1), matching the batch split.
+
+    Args:
+        chunks (iterable): (cleaned_text, source_length) pairs in order
+        figure_descriptions (list): Figure descriptions in order
+        total_length (int): Total source length of all chunks
+
+    Yields:
+        str: Text segments and figure descriptions in reading order
+    """
+    num_figures = len(figure_descriptions)
+    next_figure = 0
+    consumed = 0
+
+    for text, source_length in chunks:
+        if text.strip():
+            yield text.strip() + "\n\n"
+        consumed += source_length
+
+        while (next_figure < num_figures and
+               consumed >= total_length * (next_figure + 1) / (num_figures + 1)):
+            yield f"Figure {next_figure+1}: {figure_descriptions[next_figure]}\n\n"
+            next_figure += 1
+
+    # Any figures not yet placed go at the end
+    while next_figure < num_figures:
+        yield f"Figure {next_figure+1}: {figure_descriptions[next_figure]}\n\n"
+        next_figure += 1
+
 def main():
     import argparse
     
@@ -0,0 +1,60 @@
+import os
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+# Requests allowed in flight at once per provider, across every paper
+# processed by this interpreter. local_tts counts speech engine processes
+# on this machine, so one per core.
+DEFAULT_LIMITS = {
+    "anthropic": 16,
+    "openai": 8,
+    "local_tts": os.cpu_count() or 1,
+}
+
+# How often a coroutine waiting for a slot checks for a free one
+ASYNC_POLL_SECONDS = 0.05
+
+_semaphores = {}
+_lock = threading.Lock()
+
+def configure(**limits):
+    """
+    Set the global request budget for one or more providers, e.g.
+    configure(anthropic=8, openai=4). Call before any requests are made.
+    """
+    with _lock:
+        for provider, limit in limits.items():
+            if limit is not None:
+                _semaphores[provider] = threading.BoundedSemaphore(max(1, limit))
+
+def _semaphore(provider):
+    with _lock:
+        if provider not in _semaphores:
+            _semaphores[provider] = threading.BoundedSemaphore(DEFAULT_LIMITS.get(provider, 8))
+        return _semaphores[provider]
+
+@contextmanager
+def provider_slot(provider):
+    """Hold one of the provider's request slots for the duration of a call."""
+    semaphore = _semaphore(provider)
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+@asynccontextmanager
+async def async_provider_slot(provider):
+    """
+    provider_slot for coroutines. The slots are shared with threads, so a
+    coroutine polls for one instead of blocking the event loop; a task
+    cancelled while waiting has taken nothing and gives nothing back.
+    """
+    semaphore = _semaphore(provider)
+    while not semaphore.acquire(blocking=False):
+        await asyncio.sleep(ASYNC_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        semaphore.release()
@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from limits import provider_slot, async_provider_slot
+
+# Cached responses live outside the per-paper temp directories so they
+# survive RUN's cleanup and can be shared between papers and reruns.
+DEFAULT_CACHE_DIR = Path(os.environ.get(
+    "WMC_CACHE_DIR",
+    Path(__file__).resolve().parent.parent / ".cache" / "claude"
+))
+DEFAULT_MAX_BYTES = int(os.environ.get("WMC_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of Claude responses.
+
+    Entries are keyed by a SHA-256 of the full request (model, prompt text,
+    base64 image bytes, max_tokens, ...) so any change to the inputs is a
+    miss. Each entry is one small JSON file; its mtime is refreshed on every
+    hit and the least recently used entries are evicted once the directory
+    grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, enabled=True):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    @staticmethod
+    def key(request):
+        """Hash a messages.create request into a cache key."""
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """
+        Return the cached response as {"text", "stop_reason", "usage", ...},
+        or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if "text" not in entry:
+                raise KeyError("text")
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def contains(self, key):
+        """True if a response is stored for key, without counting a hit or miss."""
+        return self.enabled and self._path(key).exists()
+
+    def put(self, key, entry):
+        """Store a response and evict old entries if over the size cap."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+
+        with self._lock:
+            # A rewritten entry replaces the old file's bytes, not adds to them
+            try:
+                old_size = path.stat().st_size
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            if self._total_bytes is None:
+                self._total_bytes = sum(p.stat().st_size for p in self._entries())
+            else:
+                self._total_bytes += path.stat().st_size - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        return self.cache_dir.glob("*/*.json")
+
+    def _evict(self):
+        """Delete least recently used entries until under 90% of the cap."""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+    def stats(self):
+        """Summary line for logs."""
+        lookups = self.hits + self.misses
+        rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"Response cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """Process-wide cache shared by every stage."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(enabled=os.environ.get("WMC_NO_CACHE") != "1")
+        return _default_cache
+
+def cacheable_text(text):
+    """
+    A text content block marked as the end of a prompt-cache prefix.
+    Claude caches everything up to and including the block for a few
+    minutes, so later requests that start with the same blocks skip
+    reprocessing them. Prefixes shorter than the model's minimum (1024
+    tokens for Sonnet) are processed normally and never cached.
+    """
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+class PromptCacheStats:
+    """Input tokens sent to Claude by this process, and how many were read from its prompt cache."""
+
+    def __init__(self):
+        self.totals = dict.fromkeys(USAGE_FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, usage):
+        if not usage:
+            return
+        with self._lock:
+            for field in USAGE_FIELDS:
+                self.totals[field] += usage.get(field) or 0
+
+    def summary(self):
+        """Summary line for logs."""
+        with self._lock:
+            totals = dict(self.totals)
+        # input_tokens counts only the part of the prompt after the last cache breakpoint
+        prompt_tokens = (totals["input_tokens"] + totals["cache_creation_input_tokens"]
+                         + totals["cache_read_input_tokens"])
+        rate = (totals["cache_read_input_tokens"] / prompt_tokens * 100) if prompt_tokens else 0.0
+        return (f"Prompt cache: {totals['cache_read_input_tokens']} of {prompt_tokens} input tokens "
+                f"read from cache ({rate:.0f}%), {totals['cache_creation_input_tokens']} written")
+
+prompt_cache_stats = PromptCacheStats()
+
+def message_entry(message, model=None):
+    """The parts of a Messages API response worth caching."""
+    usage = getattr(message, "usage", None)
+    return {
+        "model": model,
+        "text": message.content[0].text,
+        "stop_reason": getattr(message, "stop_reason", None),
+        "usage": {
+            field: getattr(usage, field, None) for field in USAGE_FIELDS
+        } if usage is not None else None
+    }
+
+def create_message(client, request, cache=None):
+    """
+    messages.create through the cache. Returns the cache entry:
+    {"text", "stop_reason", "usage", "cached"}.
+    """
+    cache = cache or get_default_cache()
+    key = cache.key(request)
+    entry = cache.get(key)
+    if entry is None:
+        with provider_slot("anthropic"):
+            message = client.messages.create(**request)
+        entry = message_entry(message, request.get("model"))
+        prompt_cache_stats.record(entry["usage"])
+        cache.put(key, entry)
+        return dict(entry, cached=False)
+    return dict(entry, cached=True)
+
+async def acreate_message(client, request, cache=None):
+    """
+    Async variant of create_message for AsyncAnthropic clients.
+    """
+    cache = cache or get_default_cache()
+    key = cache.key(request)
+    entry = cache.get(key)
+    if entry is None:
+        async with async_provider_slot("anthropic"):
+            message = await client.messages.create(**request)
+        entry = message_entry(message, request.get("model"))
+        prompt_cache_stats.record(entry["usage"])
+        cache.put(key, entry)
+        return dict(entry, cached=False)
+    return dict(entry, cached=True)
+
+def create_text(client, request, cache=None):
+    """
+    messages.create through the cache, returning the first text block.
+    """
+    return create_message(client, request, cache)["text"]
+
+async def acreate_text(client, request, cache=None):
+    """
+    Async variant of create_text for AsyncAnthropic clients.
+    """
+    return (await acreate_message(client, request, cache))["text"]
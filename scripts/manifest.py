@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+
+def hash_inputs(*parts):
+    """
+    Hash the inputs of a unit of work. Accepts str, bytes and None;
+    each part is length-prefixed so ("ab", "c") and ("a", "bc") differ.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            data = b""
+        elif isinstance(part, bytes):
+            data = part
+        else:
+            data = str(part).encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+class Manifest:
+    """
+    Per-paper record of completed units of work (a figure description, a
+    context explanation, a cleaned body chunk, a TTS chunk, ...).
+
+    Each unit is stored with the hash of its inputs and the files it wrote,
+    and optionally its text result. A unit counts as done only if its inputs
+    are unchanged and its output files still exist, so a rerun resumes at
+    the first incomplete or stale unit.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.units = json.load(f).get("units", {})
+        except (OSError, ValueError):
+            self.units = {}
+
+    def is_done(self, unit, input_hash):
+        """True if unit completed with these inputs and its outputs are still present."""
+        with self._lock:
+            entry = self.units.get(unit)
+        if not entry or entry.get("input_hash") != input_hash:
+            return False
+        return all(os.path.exists(output) for output in entry.get("outputs", []))
+
+    def get_result(self, unit, input_hash):
+        """Stored text result of a completed unit, or None."""
+        if not self.is_done(unit, input_hash):
+            return None
+        with self._lock:
+            return self.units[unit].get("result")
+
+    def mark_done(self, unit, input_hash, outputs=(), result=None):
+        """Record a completed unit and save the manifest."""
+        entry = {"input_hash": input_hash, "outputs": [str(output) for output in outputs]}
+        if result is not None:
+            entry["result"] = result
+        with self._lock:
+            self.units[unit] = entry
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"units": self.units}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,259 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+import pytesseract
+from PIL import Image
+
+# Bump when the layout of the cached model changes so stale sidecars are rebuilt
+TEXT_MODEL_VERSION = 3
+
+# Pages with less text than this but with images on them are taken to be
+# scans, and are OCRed with Tesseract at OCR_DPI in a pool of processes
+MIN_PAGE_CHARS = 20
+OCR_DPI = 300
+OCR_WORKERS = os.cpu_count() or 1
+
+# OCR results are cached by a hash of the page's contents, so a scan is
+# only read once however many times (or under whatever name) it is processed
+OCR_CACHE_DIR = Path(os.environ.get(
+    "WMC_OCR_CACHE_DIR",
+    Path(__file__).resolve().parent.parent / ".cache" / "ocr"
+))
+
+# Parsed models kept in memory, most recently used last: enough for the
+# papers processed at once and their stages, not every paper a --watch
+# run has seen. Older ones are read back from their sidecar if needed.
+MAX_MODELS = 8
+
+_models = OrderedDict()
+_model_locks = {}
+_lock = threading.Lock()
+
+# One document is OCRed at a time, with every core, however many papers
+# are being processed at once
+_ocr_lock = threading.Lock()
+
+def file_hash(path):
+    """SHA-256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def sidecar_path(pdf_path, pdf_hash):
+    """Where the text model for a PDF with this hash is cached."""
+    pdf_path = Path(pdf_path)
+    return pdf_path.with_name(f".{pdf_path.stem}.{pdf_hash[:16]}.text.json")
+
+def needs_ocr(page, text):
+    """True for a page that is an image of text: almost no text layer, but images."""
+    return len(text.strip()) < MIN_PAGE_CHARS and bool(page.get_images())
+
+def ocr_blocks(image, scale):
+    """
+    Tesseract's paragraphs in a page image as text model blocks, with
+    bboxes converted back to PDF points by scale.
+    """
+    data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+    paragraphs = {}
+    for i, word in enumerate(data["text"]):
+        if not word.strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i])
+        line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        x0, y0 = data["left"][i], data["top"][i]
+        x1, y1 = x0 + data["width"][i], y0 + data["height"][i]
+        paragraph = paragraphs.setdefault(key, {"lines": {}, "bbox": [x0, y0, x1, y1]})
+        paragraph["lines"].setdefault(line, []).append(word)
+        bbox = paragraph["bbox"]
+        paragraph["bbox"] = [min(bbox[0], x0), min(bbox[1], y0), max(bbox[2], x1), max(bbox[3], y1)]
+
+    return [
+        {
+            "bbox": [value * scale for value in paragraph["bbox"]],
+            "text": "\n".join(" ".join(words) for words in paragraph["lines"].values()) + "\n"
+        }
+        for paragraph in paragraphs.values()
+    ]
+
+def page_hash(page, dpi=OCR_DPI):
+    """
+    Hash of what a page looks like: its content stream and the raw bytes
+    of its images, with the page geometry and OCR resolution.
+    """
+    digest = hashlib.sha256(f"{dpi}|{tuple(page.rect)}|{page.rotation}|".encode('utf-8'))
+    digest.update(page.read_contents())
+    for image in page.get_images():
+        digest.update(page.parent.xref_stream_raw(image[0]) or b"")
+    return digest.hexdigest()
+
+def _ocr_cache_path(key):
+    return OCR_CACHE_DIR / key[:2] / f"{key}.json"
+
+def ocr_page(pdf_path, page_number, dpi=OCR_DPI):
+    """Worker: render one page in grayscale and OCR it into text model blocks."""
+    with fitz.open(pdf_path) as doc:
+        pix = doc[page_number].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    return ocr_blocks(image, 72 / dpi)
+
+def ocr_pages(pdf_path, page_numbers, workers=OCR_WORKERS):
+    """
+    OCR pages of a PDF, reusing results cached by page_hash and running the
+    rest in parallel, one page per task so long and short pages spread
+    across the workers. Returns {page_number: blocks}; pages are left out
+    if Tesseract is not installed.
+    """
+    with fitz.open(pdf_path) as doc:
+        keys = {n: page_hash(doc[n]) for n in page_numbers}
+
+    results = {}
+    for page_number, key in keys.items():
+        try:
+            with open(_ocr_cache_path(key), 'r', encoding='utf-8') as f:
+                results[page_number] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    missing = [n for n in page_numbers if n not in results]
+    if not missing:
+        return results
+
+    try:
+        pytesseract.get_tesseract_version()
+    except pytesseract.TesseractNotFoundError:
+        print(f"Warning: {len(missing)} page(s) of {pdf_path} have no text layer and "
+              f"Tesseract is not installed to OCR them")
+        return results
+
+    workers = max(1, min(workers, len(missing)))
+    print(f"OCRing {len(missing)} page(s) of {pdf_path} with {workers} worker(s)...")
+    # Spawned rather than forked workers, as the pipeline calls this from
+    # its paper threads
+    context = multiprocessing.get_context("spawn")
+    with _ocr_lock, ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for page_number, blocks in zip(missing, executor.map(ocr_page, [str(pdf_path)] * len(missing), missing)):
+            results[page_number] = blocks
+            cache_path = _ocr_cache_path(keys[page_number])
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(blocks, f, ensure_ascii=False)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"Warning: could not write OCR cache {cache_path}: {e}")
+    return results
+
+def extract_text_model(pdf_path, pdf_hash=None):
+    """
+    Parse a PDF once with PyMuPDF into a per-page text and block model:
+
+        {"version", "sha256", "ocr_missing", "pages": [
+            {"number", "width", "height", "text", "ocr",
+             "blocks": [{"bbox": [x0, y0, x1, y1], "text": ...}, ...]}
+        ]}
+
+    Pages that are scans are read with OCR instead (see needs_ocr), and
+    marked with "ocr": true. Scans that could not be OCRed (no Tesseract)
+    are listed by page number in "ocr_missing".
+    """
+    pages = []
+    scanned = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            blocks = []
+            for x0, y0, x1, y1, text, _block_no, block_type in page.get_text("blocks"):
+                # Type 1 blocks are images
+                if block_type == 0 and text.strip():
+                    blocks.append({"bbox": [x0, y0, x1, y1], "text": text})
+            text = page.get_text("text")
+            if needs_ocr(page, text):
+                scanned.append(page.number)
+            pages.append({
+                "number": page.number + 1,
+                "width": page.rect.width,
+                "height": page.rect.height,
+                "text": text,
+                "ocr": False,
+                "blocks": blocks
+            })
+
+    ocr_results = ocr_pages(pdf_path, scanned) if scanned else {}
+    for page_number, blocks in ocr_results.items():
+        pages[page_number].update({
+            "text": "".join(block["text"] for block in blocks),
+            "ocr": True,
+            "blocks": blocks
+        })
+
+    return {
+        "version": TEXT_MODEL_VERSION,
+        "sha256": pdf_hash or file_hash(pdf_path),
+        "ocr_missing": [n + 1 for n in scanned if n not in ocr_results],
+        "pages": pages
+    }
+
+def load_text_model(pdf_path):
+    """
+    Return the text model for a PDF, parsing it only if neither this process
+    nor an earlier run has already done so for the same file contents.
+    """
+    pdf_hash = file_hash(pdf_path)
+    with _lock:
+        model_lock = _model_locks.setdefault(pdf_hash, threading.Lock())
+
+    # Lock per document so different papers can be parsed at the same time
+    with model_lock:
+        with _lock:
+            if pdf_hash in _models:
+                _models.move_to_end(pdf_hash)
+                return _models[pdf_hash]
+
+        cache_path = sidecar_path(pdf_path, pdf_hash)
+        model = None
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                model = json.load(f)
+            if model.get("version") != TEXT_MODEL_VERSION or model.get("sha256") != pdf_hash:
+                model = None
+        except (OSError, ValueError):
+            model = None
+
+        if model is None:
+            model = extract_text_model(pdf_path, pdf_hash)
+            # A model with scans still to OCR is only kept for this process,
+            # so the next run tries them again (e.g. once Tesseract is installed)
+            if model["ocr_missing"]:
+                print(f"Warning: not caching the text of {pdf_path} until pages "
+                      f"{model['ocr_missing']} can be OCRed")
+            else:
+                tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+                try:
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(model, f, ensure_ascii=False)
+                    os.replace(tmp_path, cache_path)
+                except OSError as e:
+                    print(f"Warning: could not write PDF text cache {cache_path}: {e}")
+
+        with _lock:
+            _models[pdf_hash] = model
+            while len(_models) > MAX_MODELS:
+                evicted, _ = _models.popitem(last=False)
+                _model_locks.pop(evicted, None)
+        return model
+
+def read_pdf_text(pdf_path):
+    """Full document text, one page after another, with a blank line between text blocks."""
+    model = load_text_model(pdf_path)
+    return "".join(
+        "".join(block["text"].strip() + "\n\n" for block in page["blocks"])
+        for page in model["pages"]
+    )
@@ -0,0 +1,464 @@
+import os
+import sys
+import argparse
+import queue
+import time
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import anthropic
+
+import get_name
+import context
+import figures
+import intersperse
+import script
+import describe
+import limits
+import batch
+import audio_assemble
+import tts_backends
+from body import PaperCleaner, clean_budget, DEFAULT_CLEAN_CONCURRENCY, DEFAULT_CLEAN_INPUT_TOKENS
+from llm_cache import get_default_cache, prompt_cache_stats
+from image_prep import image_prep_stats
+from manifest import Manifest, MANIFEST_NAME, hash_inputs
+
+# Cleaned body chunks allowed to wait between body cleaning and TTS
+STREAM_QUEUE_SIZE = 4
+
+# Watch mode: RUN touches <work_dir>/figs/.annotated when a paper's GUI
+# session ends, and <temp_dir>/.annotation_done after the last one
+READY_MARKER = ".annotated"
+DONE_MARKER = ".annotation_done"
+WATCH_POLL_SECONDS = 2
+
+# Longest title stem, in UTF-8 bytes, used for a final audio filename;
+# leaves room for a " (N)" suffix, the extension and ".part" within the
+# usual 255-byte filename limit
+MAX_STEM_BYTES = 200
+
+_DONE = object()
+
+def truncate_filename(name, max_bytes):
+    """name cut to at most max_bytes of UTF-8, at a word boundary where there is one."""
+    encoded = name.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return name
+    cut = encoded[:max_bytes].decode("utf-8", "ignore")
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip(" .") or cut
+
+def bounded_prefetch(iterable, maxsize=STREAM_QUEUE_SIZE):
+    """
+    Run a generator in a background thread, handing its items over through
+    a bounded queue. The producer keeps working while the consumer is busy,
+    and blocks once maxsize items are waiting.
+
+    When this generator is closed (or the consumer fails and drops it), the
+    producer stops at its next item and closes the source generator, so
+    nothing is left blocked on the queue or working for nobody.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+            else:
+                put(_DONE)
+        except BaseException as e:
+            put(e)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+class PaperPipeline:
+    """
+    Runs every stage for a paper inside one interpreter, sharing the
+    Anthropic and OpenAI clients (and their connection pools) across
+    stages and papers.
+
+    A work directory is laid out the way RUN prepares it:
+        <work_dir>/figs/paper.pdf and the figure_*.png files from gui.py
+
+    Every path is resolved from the work directory, never the current
+    directory, so several papers can run at once from the same process.
+    """
+
+    def __init__(self, output_dir="output_audio", voice="alloy", tts_model="tts-1-hd",
+                 describe_concurrency=describe.DEFAULT_CONCURRENCY, tts_workers=None,
+                 clean_concurrency=DEFAULT_CLEAN_CONCURRENCY, base_url=None, fused=False,
+                 audio_format=None, tts_backend=None, chunk_budget=None):
+        self.claude = anthropic.Anthropic(base_url=base_url) if base_url else anthropic.Anthropic()
+        # OpenAI by default; a local engine needs no API key or network
+        self.tts = tts_backend if tts_backend is not None else tts_backends.OpenAIBackend(None, voice, tts_model)
+        self.cleaner = PaperCleaner(client=self.claude, budget=chunk_budget, concurrency=clean_concurrency)
+        self.output_dir = Path(output_dir).resolve()
+        self.voice = voice
+        self.tts_model = tts_model
+        self.describe_concurrency = describe_concurrency
+        self.tts_workers = tts_workers
+        self.fused = fused
+        self.audio_format = audio_format or self.tts.formats[0]
+        self.tts.check_format(self.audio_format)
+
+    def extract_title(self, pdf_path):
+        """Stage 0: predict the paper title and make it safe for filenames."""
+        paper_name = get_name.predict_title(str(pdf_path), client=self.claude)
+        return get_name.sanitize_filename(paper_name)
+
+    def describe_figures(self, figs_dir, manifest=None):
+        """Stage 1: write a *_blind.txt description for every figure and panel."""
+        figures.describe_figures(str(figs_dir), concurrency=self.describe_concurrency, manifest=manifest,
+                                 client=self.claude)
+
+    def contextualize_figures(self, paper_text, figs_dir, manifest=None):
+        """Stage 2: write *_blind_contextual.txt explanations."""
+        figures.contextualize_figures(paper_text, str(figs_dir), client=self.claude, manifest=manifest)
+
+    def explain_figures(self, paper_text, figs_dir, manifest=None):
+        """Stages 1-2 fused: one request per image straight to *_blind_contextual.txt."""
+        figures.explain_figures(paper_text, str(figs_dir), concurrency=self.describe_concurrency,
+                                client=self.claude, manifest=manifest)
+
+    def clean_body(self, pdf_path, manifest=None):
+        """Stage 3: clean the paper body into figs/paper.txt."""
+        cleaned_text = self.cleaner.process_pdf(str(pdf_path), manifest)
+        output_path = pdf_path.with_suffix('.txt')
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(cleaned_text)
+        return cleaned_text
+
+    def intersperse(self, cleaned_text, figs_dir):
+        """Stage 4: place figure explanations through the body text."""
+        result = intersperse.intersperse_figures_with_text(cleaned_text, str(figs_dir))
+        with open(figs_dir / "chunks.txt", 'w', encoding='utf-8') as f:
+            f.write(result)
+        return result
+
+    def synthesize(self, text, work_dir, output_file, manifest=None):
+        """
+        Stages 5-6: synthesize chunk_NNN audio files and assemble them into
+        output_file as they finish, returning its path.
+        """
+        with audio_assemble.assembler_for(self.audio_format, output_file) as assembler:
+            script.text_to_speech(
+                input_text=text,
+                output_filename="chunks.mp3",
+                voice=self.voice,
+                model=self.tts_model,
+                backend=self.tts,
+                output_root=work_dir / "generated_audio",
+                workers=self.tts_workers,
+                manifest=manifest,
+                assembler=assembler,
+                audio_format=self.audio_format
+            )
+        return output_file
+
+    def output_file(self, paper_name, manifest=None):
+        """
+        Where the final audio for a paper goes: its title, shortened to fit
+        a filename, in the output directory. The name is claimed by creating
+        the file exclusively, with " (2)", " (3)"... added when another paper
+        (or an earlier run) already has it, so papers that share a title, or
+        that both ended up as "TITLE NOT FOUND", never write the same file.
+        The claim is kept in the paper's manifest, so a rerun of the same
+        work directory writes to the same file again.
+        """
+        stem = truncate_filename(paper_name, MAX_STEM_BYTES)
+        input_hash = hash_inputs(stem, self.audio_format, self.output_dir)
+        if manifest is not None:
+            claimed = manifest.get_result("output:file", input_hash)
+            if claimed is not None:
+                return Path(claimed)
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        number = 1
+        while True:
+            suffix = f" ({number})" if number > 1 else ""
+            output_file = self.output_dir / f"{stem}{suffix}.{self.audio_format}"
+            try:
+                os.close(os.open(output_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                number += 1
+        if manifest is not None:
+            manifest.mark_done("output:file", input_hash, [output_file], result=str(output_file))
+        return output_file
+
+    def stream_body(self, pdf_path, figs_dir, work_dir, output_file, manifest=None):
+        """
+        Stages 3-6 overlapped: cleaned chunks flow through figure
+        interspersing into TTS and the final file as soon as Claude returns
+        them, instead of each stage waiting for the previous one to finish
+        the whole paper. paper.txt and chunks.txt are still written for
+        inspection. Returns the path of the final audio.
+        """
+        source_chunks = self.cleaner.prepare_chunks(self.cleaner.extract_text(str(pdf_path)), manifest)
+        total_length = sum(len(chunk) for chunk in source_chunks)
+        cleaned_chunks = []
+        final_segments = []
+
+        def cleaned():
+            results = self.cleaner.iter_clean_chunks(source_chunks, manifest)
+            try:
+                for source, text in zip(source_chunks, results):
+                    cleaned_chunks.append(text)
+                    yield text, len(source)
+            finally:
+                results.close()
+
+        prefetched = bounded_prefetch(cleaned())
+
+        def segments():
+            figure_descriptions = intersperse.read_figure_descriptions(str(figs_dir))
+            for segment in intersperse.intersperse_stream(prefetched, figure_descriptions, total_length):
+                final_segments.append(segment)
+                yield segment
+
+        # Closing the prefetch on the way out stops the cleaning thread and
+        # its pending requests if TTS fails part way through the paper
+        try:
+            with audio_assemble.assembler_for(self.audio_format, output_file) as assembler:
+                script.text_to_speech_stream(
+                    segments(),
+                    output_filename="chunks.mp3",
+                    voice=self.voice,
+                    model=self.tts_model,
+                    backend=self.tts,
+                    output_root=work_dir / "generated_audio",
+                    workers=self.tts_workers,
+                    manifest=manifest,
+                    assembler=assembler,
+                    audio_format=self.audio_format
+                )
+        finally:
+            prefetched.close()
+
+        with open(pdf_path.with_suffix('.txt'), 'w', encoding='utf-8') as f:
+            f.write("\n\n".join(chunk for chunk in cleaned_chunks if chunk))
+        with open(figs_dir / "chunks.txt", 'w', encoding='utf-8') as f:
+            f.write("".join(final_segments))
+        return output_file
+
+    def run_paper(self, work_dir, stream=False):
+        """Run the full pipeline for one paper and return the final audio path."""
+        work_dir = Path(work_dir).resolve()
+        figs_dir = work_dir / "figs"
+        pdf_path = figs_dir / "paper.pdf"
+        if not pdf_path.exists():
+            raise FileNotFoundError(f"PDF file '{pdf_path}' does not exist.")
+
+        # Completed units from earlier runs are skipped, so a rerun after a
+        # failure resumes at the first incomplete or stale unit
+        manifest = Manifest(work_dir / MANIFEST_NAME)
+
+        paper_text = context.read_pdf(str(pdf_path))
+        paper_name = self.extract_title(pdf_path)
+        print(f"Processing: {paper_name}")
+
+        if self.fused:
+            self.explain_figures(paper_text, figs_dir, manifest)
+        else:
+            self.describe_figures(figs_dir, manifest)
+            self.contextualize_figures(paper_text, figs_dir, manifest)
+        output_file = self.output_file(paper_name, manifest)
+        try:
+            if stream:
+                return self.stream_body(pdf_path, figs_dir, work_dir, output_file, manifest)
+            cleaned_text = self.clean_body(pdf_path, manifest)
+            final_text = self.intersperse(cleaned_text, figs_dir)
+            return self.synthesize(final_text, work_dir, output_file, manifest)
+        except BaseException:
+            # Don't leave the empty placeholder that claimed the name behind
+            if output_file.exists() and output_file.stat().st_size == 0:
+                output_file.unlink()
+            raise
+
+def run_paper(work_dir, output_dir="output_audio", pipeline=None, stream=False):
+    """
+    Process one prepared work directory end to end.
+    Pass an existing PaperPipeline to reuse its clients across papers.
+    """
+    if pipeline is None:
+        pipeline = PaperPipeline(output_dir=output_dir)
+    return pipeline.run_paper(work_dir, stream=stream)
+
+def iter_annotated(temp_dir, poll_interval=WATCH_POLL_SECONDS):
+    """
+    Yield each work directory under temp_dir as soon as its figures have
+    been annotated, until the annotation phase is marked as done.
+    """
+    temp_dir = Path(temp_dir)
+    seen = set()
+    while True:
+        # Check for the done marker before scanning so the last paper is not missed
+        finished = (temp_dir / DONE_MARKER).exists()
+        for marker in sorted(temp_dir.glob(f"*/figs/{READY_MARKER}")):
+            work_dir = marker.parent.parent
+            if work_dir not in seen:
+                seen.add(work_dir)
+                print(f"Figures annotated for {work_dir.name}, starting processing")
+                yield work_dir
+        if finished:
+            return
+        time.sleep(poll_interval)
+
+def run_papers(work_dirs, pipeline, papers=1, stream=False):
+    """
+    Process several work directories, up to `papers` at a time. Each paper
+    has its own work directory and manifest; request concurrency per
+    provider is capped globally by limits.py. Returns the number of failures.
+
+    work_dirs may be a generator such as iter_annotated(); each paper is
+    submitted as soon as it is yielded.
+    """
+    def run_one(work_dir):
+        output_file = run_paper(work_dir, pipeline=pipeline, stream=stream)
+        print(f"Completed processing: {os.path.basename(os.path.normpath(work_dir))} -> {output_file}")
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, papers)) as executor:
+        futures = {executor.submit(run_one, work_dir): work_dir for work_dir in work_dirs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                failures += 1
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Turn prepared paper work directories into audio')
+    parser.add_argument('work_dirs', nargs='*',
+                      help='Work directories containing figs/paper.pdf and the extracted figures')
+    parser.add_argument('--watch', metavar='TEMP_DIR',
+                      help=f'Process each work directory in TEMP_DIR once its figs/{READY_MARKER} '
+                           f'marker appears, until TEMP_DIR/{DONE_MARKER} exists')
+    parser.add_argument('--output-dir', default='output_audio',
+                      help='Directory for the final audio files (default: output_audio)')
+    parser.add_argument('--voice', default='alloy',
+                      choices=['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer'],
+                      help='Voice to use for the speech (default: alloy)')
+    parser.add_argument('--model', default='tts-1-hd',
+                      choices=['tts-1', 'tts-1-hd'],
+                      help='Model to use (tts-1 for speed, tts-1-hd for quality)')
+    parser.add_argument('--format', choices=list(audio_assemble.AUDIO_FORMATS),
+                      help='Audio format for the chunks and the final file; opus and aac are several '
+                           f'times smaller than mp3 (default: {script.DEFAULT_FORMAT}, wav for local engines)')
+    parser.add_argument('--tts-backend', default='openai', choices=tts_backends.BACKENDS,
+                      help='Speech engine; piper and espeak-ng run locally, with no API cost or network, '
+                           'for drafts and bulk runs (default: openai)')
+    parser.add_argument('--piper-model', help='Piper voice model (.onnx) for --tts-backend piper')
+    parser.add_argument('--espeak-voice', default='en-us', help='espeak-ng voice (default: en-us)')
+    parser.add_argument('--describe-concurrency', type=int, default=describe.DEFAULT_CONCURRENCY,
+                      help=f'Maximum concurrent figure description requests (default: {describe.DEFAULT_CONCURRENCY})')
+    parser.add_argument('--clean-concurrency', type=int, default=DEFAULT_CLEAN_CONCURRENCY,
+                      help=f'Body chunks to clean at once (default: {DEFAULT_CLEAN_CONCURRENCY})')
+    parser.add_argument('--clean-input-tokens', type=int, default=DEFAULT_CLEAN_INPUT_TOKENS,
+                      help='Largest body chunk, in tokens, sent in one cleaning request '
+                           f'(default: {DEFAULT_CLEAN_INPUT_TOKENS})')
+    parser.add_argument('--clean-target-latency', type=float, default=None,
+                      help='Shrink body chunks while cleaning requests take longer than this many seconds '
+                           '(default: no latency target)')
+    parser.add_argument('--tts-workers', type=int, default=None,
+                      help=f'Audio chunks to synthesize in parallel per paper (default: {script.DEFAULT_WORKERS}, '
+                           'one per CPU core for local engines)')
+    parser.add_argument('--stream', action='store_true',
+                      help='Start synthesizing audio while the body is still being cleaned')
+    parser.add_argument('--papers', type=int, default=1,
+                      help='Papers to process at the same time (default: 1)')
+    parser.add_argument('--max-claude-requests', type=int, default=limits.DEFAULT_LIMITS["anthropic"],
+                      help='Claude requests in flight across all papers '
+                           f'(default: {limits.DEFAULT_LIMITS["anthropic"]})')
+    parser.add_argument('--max-tts-requests', type=int, default=limits.DEFAULT_LIMITS["openai"],
+                      help=f'TTS requests in flight across all papers (default: {limits.DEFAULT_LIMITS["openai"]})')
+    parser.add_argument('--max-local-tts', type=int, default=limits.DEFAULT_LIMITS["local_tts"],
+                      help='Local speech engine processes running across all papers '
+                           f'(default: {limits.DEFAULT_LIMITS["local_tts"]}, the CPU count)')
+    parser.add_argument('--no-cache', action='store_true',
+                      help='Always call Claude instead of reusing cached responses')
+    parser.add_argument('--fused', action='store_true',
+                      help='Explain each figure image in one request with the paper passages about it, '
+                           'instead of describing it first and explaining the description')
+    parser.add_argument('--batch', action='store_true',
+                      help='Send every describe, context and cleaning request through Message Batches '
+                           'first, then build the audio from the batch results')
+    parser.add_argument('--base-url',
+                      help='Anthropic API base URL, e.g. a local mock batch endpoint')
+    parser.add_argument('--batch-poll-seconds', type=float, default=batch.POLL_SECONDS,
+                      help=f'Seconds between batch status checks (default: {batch.POLL_SECONDS})')
+
+    args = parser.parse_args()
+    if not args.work_dirs and not args.watch:
+        parser.error("give work directories or --watch TEMP_DIR")
+    if args.batch and (args.watch or args.no_cache):
+        parser.error("--batch needs every work directory up front and the response cache")
+    if args.clean_input_tokens < 1:
+        parser.error("--clean-input-tokens must be at least 1")
+    if args.no_cache:
+        get_default_cache().enabled = False
+    limits.configure(anthropic=args.max_claude_requests, openai=args.max_tts_requests,
+                     local_tts=args.max_local_tts)
+    try:
+        tts_backend = tts_backends.create_backend(args.tts_backend, args.voice, args.model,
+                                                  piper_model=args.piper_model, espeak_voice=args.espeak_voice)
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+    if args.format and args.format not in tts_backend.formats:
+        parser.error(f"--tts-backend {args.tts_backend} cannot write {args.format}; "
+                     f"use {', '.join(tts_backend.formats)}")
+
+    pipeline = PaperPipeline(
+        output_dir=args.output_dir,
+        voice=args.voice,
+        tts_model=args.model,
+        describe_concurrency=args.describe_concurrency,
+        tts_workers=args.tts_workers,
+        clean_concurrency=args.clean_concurrency,
+        base_url=args.base_url,
+        fused=args.fused,
+        audio_format=args.format,
+        tts_backend=tts_backend,
+        chunk_budget=clean_budget(args.clean_input_tokens, args.clean_target_latency)
+    )
+    if args.batch:
+        batch.prefill(args.work_dirs, pipeline.claude, pipeline.cleaner,
+                      poll_seconds=args.batch_poll_seconds, fused=args.fused)
+    work_dirs = iter_annotated(args.watch) if args.watch else args.work_dirs
+    failures = run_papers(work_dirs, pipeline, papers=args.papers, stream=args.stream)
+
+    print(get_default_cache().stats())
+    print(prompt_cache_stats.summary())
+    print(image_prep_stats.summary())
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
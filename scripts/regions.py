@@ -0,0 +1,203 @@
+import re
+import sys
+
+import fitz  # PyMuPDF
+
+# Graphics closer than this (in points) are treated as one picture
+MERGE_GAP = 12
+
+# Caption-to-figure search: pieces of a figure may be separated by up to
+# PANEL_GAP of whitespace, and the figure must start within CAPTION_GAP
+# of its caption
+PANEL_GAP = 36
+CAPTION_GAP = 72
+
+# Ignore graphics smaller than this (rules, bullets, logos) and anything
+# covering nearly the whole page (backgrounds, watermarks)
+MIN_SIZE = 40
+MAX_PAGE_FRACTION = 0.9
+
+# "Figure 3." / "Fig. 3 |" / "FIGURE 3:" at the start of a text block
+CAPTION = re.compile(r'^\s*(?:Figure|FIGURE|Fig\.?|FIG\.?)\s*(\d+)\s*(?:[.:|]|\s+[A-Z])')
+
+class Region:
+    """
+    A proposed figure region on a page, in PDF points.
+
+    figure_number is the paper's own number when a caption was found
+    nearby, otherwise None. parts are the separate graphics the region was
+    built from, which are often the panels of a detailed figure.
+    """
+
+    def __init__(self, rect, figure_number=None, caption_rect=None, parts=None):
+        self.rect = fitz.Rect(rect)
+        self.figure_number = figure_number
+        self.caption_rect = caption_rect
+        self.parts = parts or [fitz.Rect(rect)]
+
+    def __repr__(self):
+        return f"Region({tuple(round(v) for v in self.rect)}, figure_number={self.figure_number}, parts={len(self.parts)})"
+
+def _near(a, b, gap):
+    """True if rects a and b overlap or are within gap points of each other."""
+    return not (a.x1 + gap < b.x0 or b.x1 + gap < a.x0 or a.y1 + gap < b.y0 or b.y1 + gap < a.y0)
+
+def merge_rects(rects, gap=MERGE_GAP):
+    """Union rects that overlap or lie within gap of each other, until none do."""
+    clusters = []
+    for rect in sorted((fitz.Rect(r) for r in rects), key=lambda r: (r.y0, r.x0)):
+        merged = fitz.Rect(rect)
+        remaining = []
+        for cluster in clusters:
+            if _near(cluster, merged, gap):
+                merged |= cluster
+            else:
+                remaining.append(cluster)
+        clusters = remaining + [merged]
+
+    # One more pass, as a union can grow into clusters seen earlier
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                if _near(clusters[i], clusters[j], gap):
+                    clusters[i] |= clusters.pop(j)
+                    changed = True
+                    break
+            if changed:
+                break
+    return clusters
+
+def graphic_rects(page):
+    """Bounding boxes of the raster images and clustered vector drawings on a page."""
+    rects = [fitz.Rect(info["bbox"]) for info in page.get_image_info()]
+    drawings = [fitz.Rect(path["rect"]) for path in page.get_drawings()]
+    rects += merge_rects([r for r in drawings if r.width > 0 or r.height > 0])
+
+    page_area = page.rect.width * page.rect.height
+    rects = [r & page.rect for r in rects]
+    return [
+        r for r in rects
+        if r.width >= MIN_SIZE and r.height >= MIN_SIZE
+        and r.width * r.height <= page_area * MAX_PAGE_FRACTION
+    ]
+
+def find_captions(page):
+    """
+    (figure_number, rect) for every caption on the page. A caption starts
+    at a line beginning "Figure N" / "Fig. N" and runs to the end of its
+    text block or the next such line; lines are checked individually
+    because PyMuPDF may put captions in two columns into one block.
+    """
+    captions = []
+    for block in page.get_text("dict")["blocks"]:
+        if block.get("type") != 0:
+            continue
+        current = None
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"])
+            rect = fitz.Rect(line["bbox"])
+            match = CAPTION.match(text)
+            if match:
+                current = [int(match.group(1)), rect]
+                captions.append(current)
+            elif current is not None and _overlaps_horizontally(rect, current[1]):
+                current[1] = current[1] | rect
+    return [(number, rect) for number, rect in captions]
+
+def _overlaps_horizontally(a, b):
+    return min(a.x1, b.x1) - max(a.x0, b.x0) > 0
+
+def _same_column(rect, caption_rect, middle):
+    """
+    False only when rect and the caption sit entirely in opposite halves of
+    the page, as with figures in the two columns of a two-column layout.
+    """
+    def half(r):
+        if r.x0 < middle < r.x1:
+            return None
+        return r.x1 <= middle
+    return None in (half(rect), half(caption_rect)) or half(rect) == half(caption_rect)
+
+def _grow(start, pool, graphics, barriers):
+    """
+    Indices of the graphics making up one figure: start plus any graphic in
+    pool within PANEL_GAP of the growing region, unless joining them would
+    take in one of the barrier rects (other figures' captions).
+    """
+    region = fitz.Rect(graphics[start])
+    members = [start]
+    added = True
+    while added:
+        added = False
+        for i in pool:
+            if i in members:
+                continue
+            graphic = graphics[i]
+            joined = region | graphic
+            if _near(graphic, region, PANEL_GAP) and not any(joined.intersects(b) for b in barriers):
+                region = joined
+                members.append(i)
+                added = True
+    return members
+
+def propose_regions(page):
+    """
+    Candidate figure regions on a page: clusters of images and vector
+    drawings, each numbered from the "Figure N" / "Fig. N" caption just
+    below (or, failing that, just above) it. Graphics with no caption are
+    still proposed, without a number.
+    """
+    pieces = graphic_rects(page)
+    graphics = merge_rects(pieces)
+    captions = find_captions(page)
+    regions = []
+    used = set()
+
+    for figure_number, caption_rect in captions:
+        column = [i for i, g in enumerate(graphics)
+                  if i not in used and _same_column(g, caption_rect, page.rect.width / 2)]
+        # Figures usually sit above their caption; look there first. The
+        # graphic nearest the caption must overlap it horizontally, while
+        # the rest of the figure may extend to either side.
+        above = [i for i in column if graphics[i].y1 <= caption_rect.y0 + MERGE_GAP]
+        below = [i for i in column if graphics[i].y0 >= caption_rect.y1 - MERGE_GAP]
+        aligned_above = [i for i in above if _overlaps_horizontally(graphics[i], caption_rect)
+                         and caption_rect.y0 - graphics[i].y1 <= CAPTION_GAP]
+        aligned_below = [i for i in below if _overlaps_horizontally(graphics[i], caption_rect)
+                         and graphics[i].y0 - caption_rect.y1 <= CAPTION_GAP]
+        if aligned_above:
+            pool = above
+            nearest = max(aligned_above, key=lambda i: graphics[i].y1)
+        elif aligned_below:
+            pool = below
+            nearest = min(aligned_below, key=lambda i: graphics[i].y0)
+        else:
+            continue
+
+        barriers = [rect for _, rect in captions if rect is not caption_rect]
+        members = _grow(nearest, pool, graphics, barriers)
+        used.update(members)
+        rect = fitz.Rect(graphics[members[0]])
+        for i in members[1:]:
+            rect |= graphics[i]
+        regions.append(Region(rect, figure_number, caption_rect, [p for p in pieces if p.intersects(rect)]))
+
+    for i, graphic in enumerate(graphics):
+        if i not in used:
+            regions.append(Region(graphic, None, None, [p for p in pieces if p.intersects(graphic)]))
+    return regions
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python regions.py <path_to_paper.pdf>")
+        sys.exit(1)
+
+    with fitz.open(sys.argv[1]) as doc:
+        for page in doc:
+            for region in propose_regions(page):
+                print(f"Page {page.number + 1}: {region}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
 from pathlib import Path
-from openai import OpenAI
-import os
 import argparse
 import sys
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from manifest import Manifest, MANIFEST_NAME, hash_inputs
+from audio_assemble import AUDIO_FORMATS
+from tts_backends import BACKENDS, DEFAULT_WORKERS, OpenAIBackend, create_backend
 
 # OpenAI TTS has a limit of approximately 4096 tokens
 # We'll use a conservative chunk size of around 1000 words
 MAX_CHUNK_SIZE = 4000  # characters
 
+# Chunks are requested in this format and kept in it through assembly.
+# The speech endpoint returns mono audio whatever the format; opus and
+# aac come back at a fraction of mp3's size with no audible loss for speech.
+# Local engines write wav.
+DEFAULT_FORMAT = "mp3"
+
 def split_into_chunks(text, max_chunk_size=MAX_CHUNK_SIZE):
     """
     Split text into chunks at sentence boundaries, respecting the max chunk size
@@ -34,6 +43,57 @@ def split_into_chunks(text, max_chunk_size=MAX_CHUNK_SIZE):
     
     return chunks
 
+def split_long(text, max_chunk_size=MAX_CHUNK_SIZE):
+    """
+    Cut text with no sentence ends in it (tables, OCR output, reference
+    lists) into pieces of at most max_chunk_size characters, at the last
+    whitespace that fits, or at exactly max_chunk_size if there is none.
+    """
+    pieces = []
+    while len(text) > max_chunk_size:
+        cut = max(text.rfind(space, 0, max_chunk_size) for space in " \n\t")
+        if cut <= 0:
+            cut = max_chunk_size
+        pieces.append(text[:cut])
+        text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+def iter_chunks(segments, max_chunk_size=MAX_CHUNK_SIZE):
+    """
+    Streaming version of split_into_chunks: consume text segments as they
+    arrive and yield each chunk as soon as the next sentence would overflow it.
+    A sentence, or a run of text with no sentence end, longer than a chunk
+    is split with split_long so no chunk is ever over max_chunk_size.
+    """
+    current_chunk = ""
+    tail = ""  # text after the last sentence end, waiting for more input
+
+    for segment in segments:
+        sentences = re.split('([.!?]+)', tail + segment)
+        tail = sentences[-1]
+        pieces = [sentences[i] + sentences[i+1] for i in range(0, len(sentences)-1, 2)]
+        if len(tail) > max_chunk_size:
+            # No sentence end in sight: don't let the tail grow without bound
+            *overflow, tail = split_long(tail, max_chunk_size)
+            pieces += overflow
+        for sentence in pieces:
+            for piece in split_long(sentence, max_chunk_size):
+                if len(current_chunk) + len(piece) <= max_chunk_size:
+                    current_chunk += piece
+                else:
+                    if current_chunk.strip():
+                        yield current_chunk.strip()
+                    current_chunk = piece
+
+    # Flush whatever is left, including a final sentence with no end mark
+    if len(current_chunk) + len(tail) > max_chunk_size:
+        if current_chunk.strip():
+            yield current_chunk.strip()
+        current_chunk = ""
+    if (current_chunk + tail).strip():
+        yield (current_chunk + tail).strip()
+
 def read_text_file(file_path):
     """Read text from a file"""
     try:
@@ -46,59 +106,123 @@ def read_text_file(file_path):
         print(f"Error reading file: {str(e)}")
         sys.exit(1)
 
-def text_to_speech(input_text, output_filename="output.mp3", voice="alloy", model="tts-1-hd"):
+def text_to_speech_stream(segments, output_filename="output.mp3", voice="alloy", model="tts-1-hd",
+                          client=None, output_root="generated_audio", workers=None,
+                          manifest=None, assembler=None, audio_format=DEFAULT_FORMAT, backend=None):
     """
-    Convert text to speech using OpenAI's API, handling long texts
+    Convert a stream of text segments to speech, submitting each chunk as
+    soon as enough text has arrived. At most 2 * workers chunks are queued
+    or in flight; beyond that the upstream generator is not pulled, which
+    holds back the stages feeding it.
+
+    Chunks are synthesized by backend, a tts_backends.TTSBackend; by
+    default OpenAI with voice, model and client. workers defaults to the
+    backend's own default.
+
+    Chunks recorded in the manifest with the same text and backend settings
+    are not synthesized again, so a rerun after a failure resumes where it stopped.
+    Without a manifest, one is kept in the chunk directory.
+
+    Chunks are requested and saved as audio_format. With an assembler
+    from audio_assemble for that format, each chunk is appended to the final
+    file as soon as it and every chunk before it are done, and the file is
+    finished when the last one lands.
+    """
+    if backend is None:
+        backend = OpenAIBackend(client, voice, model)
+    backend.check_format(audio_format)
+    output_path = Path(output_root)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # Create a directory for this specific output
+    output_dir = output_path / Path(output_filename).stem
+    output_dir.mkdir(exist_ok=True)
+
+    if manifest is None:
+        manifest = Manifest(output_dir / MANIFEST_NAME)
+
+    workers = max(1, workers or backend.default_workers)
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    failed = []
+    count = 0
+
+    def report(future, number, input_hash):
+        in_flight.release()
+        try:
+            chunk_filename = future.result()
+            manifest.mark_done(f"tts:chunk_{number:03d}", input_hash, [chunk_filename])
+            print(f"Saved chunk {number} to: {chunk_filename}")
+            if assembler is not None:
+                assembler.add(number, chunk_filename)
+        except Exception as e:
+            print(f"Error processing chunk {number}: {str(e)}")
+            failed.append(number)
+
+    # The zero-padded numbering keeps the final order deterministic
+    # however the requests finish
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in iter_chunks(segments):
+            count += 1
+            chunk_filename = output_dir / f"chunk_{count:03d}.{audio_format}"
+            input_hash = hash_inputs(chunk, *backend.hash_inputs(audio_format))
+            if manifest.is_done(f"tts:chunk_{count:03d}", input_hash):
+                print(f"Chunk {count} already synthesized, skipping")
+                if assembler is not None:
+                    assembler.add(count, chunk_filename)
+                continue
+
+            in_flight.acquire()
+            print(f"Queueing chunk {count} ({len(chunk)} characters)...")
+            future = executor.submit(backend.synthesize, chunk, chunk_filename, audio_format)
+            future.add_done_callback(lambda f, number=count, h=input_hash: report(f, number, h))
+
+    # Drop chunks left over from an earlier, longer run so stitching
+    # only picks up this text
+    for stale in output_dir.glob(f"chunk_*.{audio_format}"):
+        if int(stale.stem.split("_")[1]) > count:
+            stale.unlink()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} chunk(s) failed: {sorted(failed)}")
+    print(f"Synthesized {count} chunks")
+    if assembler is not None:
+        assembler.finish(count)
+    return output_dir
+
+def text_to_speech(input_text, output_filename="output.mp3", voice="alloy", model="tts-1-hd",
+                   client=None, output_root="generated_audio", workers=None,
+                   manifest=None, assembler=None, audio_format=DEFAULT_FORMAT, backend=None):
+    """
+    Convert text to speech using OpenAI's API or another backend, handling long texts
     """
     try:
-        client = OpenAI()
-        output_path = Path("generated_audio")
-        output_path.mkdir(exist_ok=True)
-
-        # Split text into chunks
-        chunks = split_into_chunks(input_text)
-        print(f"Split text into {len(chunks)} chunks")
-
-        # Create a directory for this specific output
-        output_dir = output_path / Path(output_filename).stem
-        output_dir.mkdir(exist_ok=True)
-
-        # Process each chunk
-        for i, chunk in enumerate(chunks):
-            chunk_filename = output_dir / f"chunk_{i+1:03d}.mp3"
-            print(f"Processing chunk {i+1}/{len(chunks)} ({len(chunk)} characters)...")
-            
-            try:
-                response = client.audio.speech.create(
-                    model=model,
-                    voice=voice,
-                    input=chunk
-                )
-                response.stream_to_file(str(chunk_filename))
-                print(f"Saved chunk {i+1} to: {chunk_filename}")
-            except Exception as e:
-                print(f"Error processing chunk {i+1}: {str(e)}")
-                raise
+        output_dir = text_to_speech_stream(
+            [input_text], output_filename, voice, model,
+            client=client, output_root=output_root, workers=workers, manifest=manifest,
+            assembler=assembler, audio_format=audio_format, backend=backend
+        )
 
         # Instead of combining files, provide information about the generated files
         print("\nProcessing complete!")
         print(f"Audio files have been saved to: {output_dir}")
         print("\nGenerated files:")
-        for file in sorted(output_dir.glob("*.mp3")):
+        for file in sorted(output_dir.glob(f"*.{audio_format}")):
             print(f"- {file.name}")
         
         # Provide command to combine files (if user wants to)
-        print("\nTo combine these files using ffmpeg, you can run:")
-        print(f"""cd generated_audio/final && echo -e "file 'chunk_001.mp3'\nfile 'chunk_002.mp3'\nfile 'chunk_003.mp3'\nfile 'chunk_004.mp3'\nfile 'chunk_005.mp3'\nfile 'chunk_006.mp3'" > filelist.txt && ffmpeg -f concat -safe 0 -i filelist.txt -c copy ../final.mp3""")
+        if assembler is None:
+            print("\nTo combine these files into one, you can run:")
+            print(f"python {Path(__file__).with_name('audio_assemble.py')} {output_dir}.{audio_format} "
+                  f"{output_dir}/chunk_*.{audio_format}")
         
         return str(output_dir)
 
     except Exception as e:
         print(f"Error generating speech: {str(e)}")
-        sys.exit(1)
+        raise
 
 def main():
-    parser = argparse.ArgumentParser(description='Convert text file to speech using OpenAI API')
+    parser = argparse.ArgumentParser(description='Convert text file to speech using OpenAI API or a local engine')
     parser.add_argument('file', help='Path to the text file to convert')
     parser.add_argument('--voice', default='alloy', 
                       choices=['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer'],
@@ -107,13 +231,30 @@ def main():
                       choices=['tts-1', 'tts-1-hd'],
                       help='Model to use (tts-1 for speed, tts-1-hd for quality)')
     parser.add_argument('--output', '-o', default=None,
-                      help='Output filename (default: input_filename.mp3)')
+                      help='Output filename (default: input_filename with the format\'s extension)')
+    parser.add_argument('--format', choices=list(AUDIO_FORMATS),
+                      help=f'Audio format to request and save (default: {DEFAULT_FORMAT}, wav for local engines)')
+    parser.add_argument('--workers', type=int, default=None,
+                      help=f'Chunks to synthesize in parallel (default: {DEFAULT_WORKERS}, '
+                           'one per CPU core for local engines)')
+    parser.add_argument('--backend', default='openai', choices=BACKENDS,
+                      help='Speech engine; piper and espeak-ng run locally, with no API cost (default: openai)')
+    parser.add_argument('--piper-model', help='Piper voice model (.onnx) for --backend piper')
+    parser.add_argument('--espeak-voice', default='en-us', help='espeak-ng voice (default: en-us)')
 
     args = parser.parse_args()
     input_path = Path(args.file)
+    try:
+        backend = create_backend(args.backend, args.voice, args.model,
+                                 piper_model=args.piper_model, espeak_voice=args.espeak_voice)
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+    args.format = args.format or backend.formats[0]
+    if args.format not in backend.formats:
+        parser.error(f"--backend {args.backend} cannot write {args.format}; use {', '.join(backend.formats)}")
     
     if args.output is None:
-        args.output = f"{input_path.stem}.mp3"
+        args.output = f"{input_path.stem}.{args.format}"
 
     print(f"Reading text from: {input_path}")
     input_text = read_text_file(str(input_path))
@@ -123,7 +264,10 @@ def main():
             input_text=input_text,
             output_filename=args.output,
             voice=args.voice,
-            model=args.model
+            model=args.model,
+            workers=args.workers,
+            audio_format=args.format,
+            backend=backend
         )
         print(f"\nAll audio chunks have been saved to: {output_dir}")
         
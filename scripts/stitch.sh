@@ -1,28 +1,18 @@
 #!/bin/bash
 
-# Directory containing your audio files
-audio_dir="generated_audio/chunks"
-output_dir="../../../../output_audio"
+# Usage: stitch.sh <paper_name> [chunks_dir] [output_dir] [format]
+# Paths are taken relative to the current directory, which no longer has
+# to be the paper's work directory. The output directory defaults to the
+# repository's output_audio, wherever this is run from.
 filename=$1
-output_file="$output_dir/$filename.mp3"
-filelist="filelist.txt"
-
-# Navigate to the directory
-cd "$audio_dir"
-
-# Generate the file list
-> "$filelist" # Clear or create filelist.txt
-for file in chunk_*.mp3; do
-  echo "file '$file'" >> "$filelist"
-done
+audio_dir="${2:-generated_audio/chunks}"
+script_dir="$(cd "$(dirname "$0")" && pwd)"
+output_dir="${3:-$script_dir/../output_audio}"
+format="${4:-mp3}"
 
 # Ensure the output directory exists
 mkdir -p "$output_dir"
+output_file="$(cd "$output_dir" && pwd)/$filename.$format"
 
-# Use ffmpeg to concatenate the files
-ffmpeg -f concat -safe 0 -i "$filelist" -c copy "$output_file"
-
-# Cleanup
-#rm "$filelist"
-
-echo "All files concatenated into $output_file"
+# Append the chunks' audio in order, without re-encoding
+python "$script_dir/audio_assemble.py" "$output_file" "$audio_dir"/chunk_*."$format" || exit 1
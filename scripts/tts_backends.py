@@ -0,0 +1,173 @@
+import os
+import time
+import shutil
+import subprocess
+from pathlib import Path
+
+from openai import OpenAI
+
+from limits import provider_slot
+
+# Chunks synthesized in parallel with OpenAI, and attempts per chunk
+# before giving up
+DEFAULT_WORKERS = 4
+MAX_RETRIES = 3
+
+class TTSBackend:
+    """
+    A speech engine that turns one chunk of text into one audio file.
+    synthesize() is called from text_to_speech_stream's worker threads,
+    several chunks at a time.
+    """
+
+    # Audio formats the engine can write, preferred first
+    formats = ()
+    default_workers = DEFAULT_WORKERS
+
+    def synthesize(self, text, output_path, audio_format):
+        raise NotImplementedError
+
+    def hash_inputs(self, audio_format):
+        """The settings that, with the text, determine the audio, for the manifest."""
+        raise NotImplementedError
+
+    def check_format(self, audio_format):
+        if audio_format not in self.formats:
+            raise ValueError(f"{type(self).__name__} cannot write '{audio_format}'; "
+                             f"use one of {', '.join(self.formats)}")
+
+class OpenAIBackend(TTSBackend):
+    """OpenAI's speech endpoint. Each chunk is streamed to disk and retried with backoff."""
+
+    formats = ("mp3", "opus", "aac", "wav")
+
+    def __init__(self, client=None, voice="alloy", model="tts-1-hd", retries=MAX_RETRIES):
+        self.client = client if client is not None else OpenAI()
+        self.voice = voice
+        self.model = model
+        self.retries = retries
+
+    def hash_inputs(self, audio_format):
+        # mp3 chunks hash as they always have, so earlier runs are still reused
+        if audio_format == "mp3":
+            return (self.voice, self.model)
+        return (self.voice, self.model, audio_format)
+
+    def synthesize(self, text, output_path, audio_format):
+        """
+        Stream the audio into a temporary file that is renamed into place
+        only once complete.
+        """
+        output_path = Path(output_path)
+        part_path = output_path.with_name(output_path.name + ".part")
+        for attempt in range(1, self.retries + 1):
+            try:
+                with provider_slot("openai"), self.client.audio.speech.with_streaming_response.create(
+                    model=self.model,
+                    voice=self.voice,
+                    input=text,
+                    response_format=audio_format
+                ) as response:
+                    response.stream_to_file(str(part_path))
+                os.replace(part_path, output_path)
+                return output_path
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = 2 ** attempt
+                print(f"Chunk {output_path.name} failed ({e}), retrying in {delay}s ({attempt}/{self.retries})...")
+                time.sleep(delay)
+
+class LocalBackend(TTSBackend):
+    """
+    A speech engine run as a command on this machine: no API cost and no
+    network. Each chunk is a separate engine process reading the text on
+    stdin, so chunks spread across the CPU cores; the "local_tts" slots in
+    limits keep papers processed at once from oversubscribing them.
+    """
+
+    formats = ("wav",)
+    default_workers = os.cpu_count() or 1
+    executable = None
+
+    def __init__(self, executable=None):
+        self.executable = executable or self.executable
+        if shutil.which(self.executable) is None:
+            raise FileNotFoundError(f"'{self.executable}' was not found on PATH")
+
+    def command(self, output_path):
+        raise NotImplementedError
+
+    def stdin_text(self, text):
+        """The text as written to the engine's stdin."""
+        return text
+
+    def synthesize(self, text, output_path, audio_format):
+        self.check_format(audio_format)
+        output_path = Path(output_path)
+        part_path = output_path.with_name(output_path.name + ".part")
+        with provider_slot("local_tts"):
+            result = subprocess.run(self.command(part_path), input=self.stdin_text(text).encode("utf-8"), capture_output=True)
+        if result.returncode != 0 or not part_path.exists():
+            part_path.unlink(missing_ok=True)
+            raise RuntimeError(f"{self.executable} failed with exit code {result.returncode}: "
+                               f"{result.stderr.decode('utf-8', 'replace').strip()}")
+        os.replace(part_path, output_path)
+        return output_path
+
+class PiperBackend(LocalBackend):
+    """Piper neural TTS, with a voice model (.onnx, its .onnx.json next to it)."""
+
+    executable = "piper"
+
+    def __init__(self, model_path, executable=None):
+        super().__init__(executable)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Piper voice model '{model_path}' does not exist")
+        self.model_path = str(model_path)
+
+    def hash_inputs(self, audio_format):
+        # "single-line" marks chunks synthesized since newlines were joined;
+        # earlier ones lost all but their last paragraph and are redone
+        return ("piper", os.path.basename(self.model_path), audio_format, "single-line")
+
+    def command(self, output_path):
+        return [self.executable, "--model", self.model_path, "--output_file", str(output_path)]
+
+    def stdin_text(self, text):
+        # piper synthesizes each stdin line separately and rewrites
+        # --output_file for every one, so only the last paragraph of a
+        # chunk would survive; send the chunk as a single line
+        return " ".join(text.split())
+
+class EspeakBackend(LocalBackend):
+    """espeak-ng formant synthesis: robotic, but fast and installed almost everywhere."""
+
+    executable = "espeak-ng"
+
+    def __init__(self, voice="en-us", words_per_minute=175, executable=None):
+        super().__init__(executable)
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+
+    def hash_inputs(self, audio_format):
+        return ("espeak-ng", self.voice, self.words_per_minute, audio_format)
+
+    def command(self, output_path):
+        return [self.executable, "-v", self.voice, "-s", str(self.words_per_minute),
+                "-w", str(output_path), "--stdin"]
+
+BACKENDS = ("openai", "piper", "espeak-ng")
+
+def create_backend(name="openai", voice="alloy", model="tts-1-hd", client=None,
+                   piper_model=None, espeak_voice="en-us"):
+    """Build a backend by name from the command line options."""
+    if name == "openai":
+        return OpenAIBackend(client, voice, model)
+    if name == "piper":
+        if not piper_model:
+            raise ValueError("the piper backend needs a voice model (--piper-model)")
+        return PiperBackend(piper_model)
+    if name == "espeak-ng":
+        return EspeakBackend(espeak_voice)
+    raise ValueError(f"Unknown TTS backend '{name}'; use one of {', '.join(BACKENDS)}")